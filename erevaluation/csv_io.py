@@ -0,0 +1,34 @@
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    # pyarrow is optional: fall back to pandas' own CSV reader/writer
+    PYARROW_AVAILABLE = False
+
+
+# ============================================================
+# CSV load / save (multithreaded pyarrow when installed)
+# ============================================================
+def read_csv(path):
+    if not PYARROW_AVAILABLE:
+        return pd.read_csv(path)
+
+    # Empty cells become NaN, matching pd.read_csv
+    convert_options = pacsv.ConvertOptions(strings_can_be_null=True)
+    # Output / LLM_Output cells hold quoted multi-line records; without this
+    # pyarrow splits blocks at those newlines and loses sync on files > 1 block
+    parse_options = pacsv.ParseOptions(newlines_in_values=True)
+    table = pacsv.read_csv(path, parse_options=parse_options, convert_options=convert_options)
+    return table.to_pandas()
+
+
+def write_csv(df, path):
+    if not PYARROW_AVAILABLE:
+        df.to_csv(path, index=False)
+        return
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pacsv.write_csv(table, path, write_options=pacsv.WriteOptions(quoting_style="needed"))
@@ -1,43 +1,169 @@
 import argparse
+import asyncio
+import re
 import pandas as pd
-import requests
+import aiohttp
 from datetime import datetime
 import os
 
+import csv_io
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    # orjson is optional; fall back to the stdlib encoder/decoder
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    json_loads = json.loads
+
+# Placeholders filled per row in the prompt template
+PLACEHOLDER_RE = re.compile(r"(\{entity_types\}|\{input_text\})")
+
 # ------------------------
 # OLLAMA CALL FUNCTION
 # ------------------------
-def run_ollama_inference(prompt, model_name, ollama_url, timeout=120):
+async def run_ollama_inference(session, prompt, model_name, ollama_url, timeout=120, keep_alive=None):
+    payload = {
+        "model": model_name,
+        "prompt": prompt,
+        "stream": False
+    }
+    if keep_alive:
+        # Keeps the model resident on the server between rows
+        payload["keep_alive"] = keep_alive
+
     try:
-        response = requests.post(
+        async with session.post(
             ollama_url,
-            json={
-                "model": model_name,
-                "prompt": prompt,
-                "stream": False
-            },
-            timeout=timeout
-        )
-        response.raise_for_status()
-
-        return response.json().get('response', '')
-
-    except requests.exceptions.Timeout:
+            data=json_dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            if response.status >= 400:
+                body = await response.text()
+                raise Exception(f"HTTP error occurred: {response.status} {response.reason} - {body}")
+
+            data = json_loads(await response.read())
+            return data.get('response', '')
+
+    except asyncio.TimeoutError:
         raise Exception("Ollama inference timed out.")
-    except requests.exceptions.HTTPError as http_err:
-        raise Exception(f"HTTP error occurred: {http_err} - {response.text}")
-    except requests.exceptions.RequestException as req_err:
+    except aiohttp.ClientError as req_err:
         raise Exception(f"Request failed: {req_err}")
     except ValueError:
         raise Exception("Invalid JSON response received from Ollama.")
 
 
+async def warm_up_model(session, args, ollama_url):
+    # An empty prompt makes Ollama load the model without generating, so the
+    # first real row does not pay the cold-load cost
+    print(f"Warming up model '{args.model_name}' (keep_alive={args.keep_alive}) ...")
+    try:
+        await run_ollama_inference(
+            session,
+            "",
+            args.model_name,
+            ollama_url,
+            timeout=args.timeout,
+            keep_alive=args.keep_alive
+        )
+    except Exception as e:
+        print(f"WARNING: model warm-up failed: {e}")
+
+
+async def process_row(session, semaphore, idx, total, full_prompt, entity_types, args, ollama_url):
+    # Semaphore bounds the number of in-flight requests to the Ollama server
+    async with semaphore:
+        print(f"\nProcessing row {idx+1}/{total} ...")
+        print(f"Entity Types: {entity_types}")
+
+        try:
+            return await run_ollama_inference(
+                session,
+                full_prompt,
+                args.model_name,
+                ollama_url,
+                timeout=args.timeout,
+                keep_alive=args.keep_alive
+            )
+        except Exception as e:
+            print(f"ERROR on row {idx}: {e}")
+            return f"ERROR: {e}"
+
+
+def build_prompts(df, PROMPT_TEMPLATE):
+    # The template splits into static text alternating with placeholders, so
+    # every prompt is rendered at once by concatenating whole columns.
+    columns = {
+        "{entity_types}": df["Entity_Types"].astype(str),
+        "{input_text}": df["Input_Text"].astype(str),
+    }
+    prompts = pd.Series("", index=df.index, dtype=object)
+    for i, part in enumerate(PLACEHOLDER_RE.split(PROMPT_TEMPLATE)):
+        prompts = prompts + (columns[part] if i % 2 else part)
+    return prompts.tolist()
+
+
+def max_in_flight(args):
+    # With --batch_size every row of a batch is in flight together;
+    # otherwise --concurrency caps the requests in flight.
+    # (run_pipeline.py shares make_connector but has no --batch_size.)
+    return getattr(args, "batch_size", None) or args.concurrency
+
+
+def make_connector(args):
+    # One pooled connector for the whole run: connections are kept alive and
+    # reused across rows instead of paying a new TCP handshake per request.
+    return aiohttp.TCPConnector(limit=max_in_flight(args), keepalive_timeout=60)
+
+
+async def run_all_rows(df, PROMPT_TEMPLATE, args, ollama_url):
+    semaphore = asyncio.Semaphore(max_in_flight(args))
+    prompts = build_prompts(df, PROMPT_TEMPLATE)
+    entity_types = df["Entity_Types"].to_numpy()
+
+    batch_size = args.batch_size or len(df)
+    results = []
+
+    async with aiohttp.ClientSession(connector=make_connector(args)) as session:
+        await warm_up_model(session, args, ollama_url)
+
+        # Rows are submitted one batch at a time; every prompt in a batch is
+        # in flight together so the server can schedule them side by side.
+        for start in range(0, len(df), batch_size):
+            end = min(start + batch_size, len(df))
+            print(f"\nSubmitting batch of {end - start} rows (rows {start+1}-{end} of {len(df)}) ...")
+
+            tasks = [
+                process_row(session, semaphore, i, len(df), prompts[i], entity_types[i], args, ollama_url)
+                for i in range(start, end)
+            ]
+
+            # gather preserves task order, so results line up with df rows
+            results.extend(await asyncio.gather(*tasks, return_exceptions=True))
+
+    return [f"ERROR: {r}" if isinstance(r, BaseException) else r for r in results]
+
+
 # ------------------------
 # MAIN PIPELINE
 # ------------------------
 def main():
 
-    parser = argparse.ArgumentParser(description="Run LLM extraction on CSV rows.")
+    parser = argparse.ArgumentParser(
+        description="Run LLM extraction on CSV rows.",
+        epilog=(
+            "Server-side parallelism is controlled by the Ollama server, not this script: "
+            "start `ollama serve` with OLLAMA_NUM_PARALLEL=<n> (requests decoded concurrently "
+            "per model) and OLLAMA_MAX_LOADED_MODELS=<m> (models kept resident). "
+            "Set --concurrency (or --batch_size, which overrides it) to match OLLAMA_NUM_PARALLEL."
+        )
+    )
     parser.add_argument("--csv_path", type=str, required=True,
                         help="Path to input CSV file.")
     parser.add_argument("--output_csv", type=str, required=True,
@@ -54,6 +180,13 @@ def main():
                     help="Limit number of rows to process (optional)")
     parser.add_argument("--results_dir", type=str, required=True,
                         help="Results dir")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Max concurrent Ollama requests (default 4; ignored with --batch_size).")
+    parser.add_argument("--keep_alive", type=str, default="1h",
+                        help="How long Ollama keeps the model loaded between requests (default 1h).")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Rows submitted together per batch, all in flight at once; overrides "
+                             "--concurrency (default: all rows, --concurrency at a time).")
 
     args = parser.parse_args()
 
@@ -65,40 +198,14 @@ def main():
         PROMPT_TEMPLATE = f.read()
 
     # Load CSV
-    df = pd.read_csv(args.csv_path)
+    df = csv_io.read_csv(args.csv_path)
     #df = pd.read_csv(args.csv_path).sample(frac=1, random_state=42).head(500)
 
     if args.limit:
         df = df.head(args.limit)
         #df = pd.read_csv(args.csv_path).sample(frac=1, random_state=42).head(500)
 
-    outputs = []
-
-    for idx, row in df.iterrows():
-        entity_types = row["Entity_Types"]
-        input_text = row["Input_Text"]
-
-        # Prepare full prompt
-        full_prompt = PROMPT_TEMPLATE
-        full_prompt = full_prompt.replace("{entity_types}", entity_types)
-        full_prompt = full_prompt.replace("{input_text}", input_text)
-
-        print(f"\nProcessing row {idx+1}/{len(df)} ...")
-        print(f"Entity Types: {entity_types}")
-
-        # Run inference
-        try:
-            llm_output = run_ollama_inference(
-                full_prompt,
-                args.model_name,
-                ollama_url,
-                timeout=args.timeout
-            )
-        except Exception as e:
-            print(f"ERROR on row {idx}: {e}")
-            llm_output = f"ERROR: {e}"
-
-        outputs.append(llm_output)
+    outputs = asyncio.run(run_all_rows(df, PROMPT_TEMPLATE, args, ollama_url))
 
     base_results_dir = args.results_dir
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -106,7 +213,7 @@ def main():
     os.makedirs(run_dir, exist_ok=True)
     df["LLM_Output"] = outputs
     output_path = os.path.join(run_dir, args.output_csv)
-    df.to_csv(output_path, index=False)
+    csv_io.write_csv(df, output_path)
 
     # Save outputs
     #df["LLM_Output"] = outputs
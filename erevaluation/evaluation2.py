@@ -1,11 +1,16 @@
 import argparse
+import csv
+import numpy as np
 import pandas as pd
 import re
 import time
 import os
 from datetime import datetime
-from typing import List, Dict
-from collections import defaultdict
+from functools import lru_cache
+from typing import List
+from collections import Counter, defaultdict
+
+import csv_io
 
 # ============================================================
 # Constants
@@ -14,6 +19,9 @@ TUPLE_DELIM = "{tuple_delimiter}"
 RECORD_DELIM = "{record_delimiter}"
 COMPLETION_DELIM = "{completion_delimiter}"
 
+# Compiled once; matched against every record of every row
+RECORD_RE = re.compile(r'^\(\s*"(entity|relationship)"\s*(.*)\)\s*$')
+
 # Define all entity types you care about globally
 ALL_ENTITY_TYPES = [
     "person",
@@ -25,23 +33,57 @@ ALL_ENTITY_TYPES = [
     "organization",
 ]
 
+# Per-type counts are kept in (N_TYPES, 3) int arrays: one row per entity
+# type, columns TP / FP / FN
+TYPE_IDX = {etype: i for i, etype in enumerate(ALL_ENTITY_TYPES)}
+N_TYPES = len(ALL_ENTITY_TYPES)
+TP, FP, FN = 0, 1, 2
+
+# Column layout of row_eval.csv and detailed_pairs.csv
+ROW_EVAL_FIELDS = [
+    "Row_ID",
+    "TP_entities", "FP_entities", "FN_entities",
+    "Entity_Precision", "Entity_Recall", "Entity_F1",
+    "TP_rel", "FP_rel", "FN_rel",
+    "Rel_Precision", "Rel_Recall", "Rel_F1",
+] + [
+    f"{etype}_{metric}" for etype in ALL_ENTITY_TYPES for metric in ("TP", "FP", "FN", "F1")
+]
+
+DETAILED_FIELDS = [
+    "Row_ID",
+    "TP_entities", "FP_entities", "FN_entities",
+    "TP_rel", "FP_rel", "FN_rel",
+    "TP_entity_pairs", "FP_entity_pairs", "FN_entity_pairs",
+    "TP_relation_pairs", "FP_relation_pairs", "FN_relation_pairs",
+]
+
 
 # ============================================================
 # Logging helper
 # ============================================================
-def log(msg: str, logfile: str):
+def log(msg: str, log_fh):
+    """log_fh: log file handle opened once by main()."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     line = f"[{timestamp}] {msg}"
     print(line)
-    with open(logfile, "a") as f:
-        f.write(line + "\n")
+    log_fh.write(line + "\n")
 
 
 # ============================================================
 # Normalize
 # ============================================================
+# Memoized: entity types have only a handful of distinct values and
+# entity names repeat heavily between gold and predicted outputs
+@lru_cache(maxsize=100_000)
 def normalize_text(s: str) -> str:
-    return " ".join(s.strip().lower().split())
+    s = s.strip().lower()
+    # Fast path: no runs of spaces and no tabs/newlines/other whitespace
+    # (isprintable() is False for every whitespace char except " "), so
+    # the split/join would return the string unchanged
+    if "  " not in s and s.isprintable():
+        return s
+    return " ".join(s.split())
 
 
 # ============================================================
@@ -63,7 +105,11 @@ def parse_delimited_output(raw: str, allowed_types: List[str]):
         if not rec or COMPLETION_DELIM in rec:
             break
 
-        m = re.match(r'^\(\s*"(entity|relationship)"\s*(.*)\)\s*$', rec)
+        # Cheap prefix check skips free-text lines before invoking the regex
+        if not rec.startswith("("):
+            continue
+
+        m = RECORD_RE.match(rec)
         if not m:
             continue
 
@@ -79,7 +125,7 @@ def parse_delimited_output(raw: str, allowed_types: List[str]):
             name = normalize_text(fields[0])
 
             # FIX 2: normalize entity type
-            etype = normalize_text(fields[1]).lower()
+            etype = normalize_text(fields[1])
 
             if etype in allowed_lower:
                 entities.append((name, etype))
@@ -91,6 +137,65 @@ def parse_delimited_output(raw: str, allowed_types: List[str]):
 
     return {"entities": entities, "relations": relations}
 
+def parse_delimited_column(raw: pd.Series, allowed_types: pd.Series):
+    """
+    Column-wise version of parse_delimited_output.
+
+    raw: Series of delimited outputs (one per row)
+    allowed_types: Series of allowed-type lists, aligned with raw
+
+    Returns:
+        list of {"entities": [...], "relations": [...]}, one per row
+    """
+    raw = raw.reset_index(drop=True)
+    allowed_types = allowed_types.reset_index(drop=True)
+    n_rows = len(raw)
+
+    is_str = raw.map(lambda v: isinstance(v, str)).astype(bool)
+    if not is_str.any():
+        # e.g. an all-empty column, which is read as float64 NaN
+        return [{"entities": [], "relations": []} for _ in range(n_rows)]
+
+    # One record per line, tagged with the position of its source row
+    recs = raw[is_str].astype(object).str.split(RECORD_DELIM).explode().str.strip()
+
+    # Everything from the first empty / completion record onwards is dropped
+    stop = (recs == "") | recs.str.contains(COMPLETION_DELIM, regex=False)
+    recs = recs[~stop.groupby(level=0).cummax()]
+
+    m = recs.str.extract(RECORD_RE).dropna()
+    rec_type = m[0]
+    rest = m[1].str.removeprefix(TUPLE_DELIM)
+
+    fields = rest.str.split(TUPLE_DELIM)
+    has_two = fields.str.len() >= 2
+    rec_type = rec_type[has_two]
+    first = fields[has_two].str[0].map(normalize_text)
+    second = fields[has_two].str[1].map(normalize_text)
+
+    # Entities: keep only types allowed for their own row
+    ent_mask = rec_type == "entity"
+    allowed = allowed_types.map(lambda ts: [t.lower().strip() for t in ts]).explode().dropna()
+    allowed_index = pd.MultiIndex.from_arrays([allowed.index, allowed.to_numpy()])
+    ent_index = pd.MultiIndex.from_arrays([first[ent_mask].index, second[ent_mask].to_numpy()])
+    ent_keep = ent_index.isin(allowed_index)
+
+    ent_names = first[ent_mask][ent_keep]
+    ent_types = second[ent_mask][ent_keep]
+    entities = pd.Series(list(zip(ent_names, ent_types)), index=ent_names.index, dtype=object)
+
+    rel_mask = rec_type == "relationship"
+    relations = pd.Series(list(zip(first[rel_mask], second[rel_mask])), index=first[rel_mask].index, dtype=object)
+
+    # Regroup the flat records back into per-row lists
+    ent_by_row = entities.groupby(level=0).agg(list).to_dict()
+    rel_by_row = relations.groupby(level=0).agg(list).to_dict()
+
+    return [
+        {"entities": ent_by_row.get(i, []), "relations": rel_by_row.get(i, [])}
+        for i in range(n_rows)
+    ]
+
 # ============================================================
 # PRF1
 # ============================================================
@@ -101,61 +206,217 @@ def compute_prf1(tp: int, fp: int, fn: int):
     return precision, recall, f1
 
 
+def compute_prf1_array(counts: np.ndarray):
+    """Elementwise compute_prf1 over a (N_TYPES, 3) TP/FP/FN count array."""
+    tp, fp, fn = counts[:, TP], counts[:, FP], counts[:, FN]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return precision, recall, f1
+
+
 # ============================================================
 # Entity Scoring (Global + Per-Type)
 # ============================================================
-def score_entities(gold_entities, pred_entities):
+def match_multisets(gold_items, pred_items):
+    """
+    gold_items, pred_items: lists of hashable records (entity or relation tuples)
+
+    Duplicates are honored: each gold record can be matched at most once,
+    so matching is a multiset intersection of the two lists.
+
+    Returns Counters (matched, unmatched_pred, unmatched_gold), i.e. TP/FP/FN.
     """
-    gold_entities: list of (name, type)
-    pred_entities: list of (name, type)
+    gold_counter = Counter(gold_items)
+    pred_counter = Counter(pred_items)
+    return (
+        pred_counter & gold_counter,
+        pred_counter - gold_counter,
+        gold_counter - pred_counter,
+    )
+
+
+def score_entities(entity_match):
+    """
+    entity_match: (matched, unmatched_pred, unmatched_gold) from match_multisets()
+                  over (name, type) entity tuples
 
     Returns:
         overall_counts: {"tp": int, "fp": int, "fn": int}
-        per_type_counts: {etype: {"tp": int, "fp": int, "fn": int}}
+        per_type_counts: (N_TYPES, 3) int array of TP/FP/FN, rows in ALL_ENTITY_TYPES order
     """
-    # Initialize per-type counts for all known types
-    per_type_counts: Dict[str, Dict[str, int]] = {
-        etype: {"tp": 0, "fp": 0, "fn": 0} for etype in ALL_ENTITY_TYPES
-    }
+    per_type_counts = np.zeros((N_TYPES, 3), dtype=np.int64)
+
+    matched, unmatched_pred, unmatched_gold = entity_match
+    tp = sum(matched.values())
+    fp = sum(unmatched_pred.values())
+    fn = sum(unmatched_gold.values())
 
-    gold_used = [False] * len(gold_entities)
-    tp = fp = fn = 0
-
-    # ---- STEP 1: Process predictions (TP / FP) ----
-    for p_name, p_type in pred_entities:
-        match_index = None
-        # Find an unused matching gold entity
-        for i, (g_name, g_type) in enumerate(gold_entities):
-            if (not gold_used[i]) and (p_name == g_name) and (p_type == g_type):
-                match_index = i
-                break
-
-        if match_index is not None:
-            # True Positive
-            tp += 1
-            gold_used[match_index] = True
-            if p_type not in per_type_counts:
-                per_type_counts[p_type] = {"tp": 0, "fp": 0, "fn": 0}
-            per_type_counts[p_type]["tp"] += 1
-        else:
-            # False Positive
-            fp += 1
-            if p_type not in per_type_counts:
-                per_type_counts[p_type] = {"tp": 0, "fp": 0, "fn": 0}
-            per_type_counts[p_type]["fp"] += 1
-
-    # ---- STEP 2: Remaining unused gold entities are FNs ----
-    for used_flag, (g_name, g_type) in zip(gold_used, gold_entities):
-        if not used_flag:
-            fn += 1
-            if g_type not in per_type_counts:
-                per_type_counts[g_type] = {"tp": 0, "fp": 0, "fn": 0}
-            per_type_counts[g_type]["fn"] += 1
+    # TP = matched, FP = unmatched predictions, FN = unmatched gold
+    for col, counter in zip((TP, FP, FN), entity_match):
+        for (_, etype), n in counter.items():
+            # Types outside ALL_ENTITY_TYPES only count towards the overall scores
+            row = TYPE_IDX.get(etype)
+            if row is not None:
+                per_type_counts[row, col] += n
 
     overall_counts = {"tp": tp, "fp": fp, "fn": fn}
     return overall_counts, per_type_counts
 
 
+# ============================================================
+# Row Evaluation
+# ============================================================
+def new_totals():
+    """Global counters accumulated by evaluate_row()."""
+    return {
+        "entities": {"tp": 0, "fp": 0, "fn": 0},
+        "relations": {"tp": 0, "fp": 0, "fn": 0},
+        "per_type": np.zeros((N_TYPES, 3), dtype=np.int64),
+    }
+
+
+def evaluate_row(row_id, gold, pred, totals):
+    """
+    gold, pred: parsed outputs {"entities": [...], "relations": [...]}
+    totals: global counters from new_totals(), updated in place
+
+    Returns:
+        row_dict: record for row_eval.csv
+        detailed_dict: record for detailed_pairs.csv
+    """
+    gold_entities = gold["entities"]
+    pred_entities = pred["entities"]
+    gold_rel = gold["relations"]
+    pred_rel = pred["relations"]
+
+    # ========================================================
+    # ENTITY SCORING (GLOBAL + PER-TYPE)
+    # ========================================================
+    entity_match = match_multisets(gold_entities, pred_entities)
+    overall_e, per_type_e_row = score_entities(entity_match)
+
+    tp_e = overall_e["tp"]
+    fp_e = overall_e["fp"]
+    fn_e = overall_e["fn"]
+
+    # Update global overall entity counters
+    totals["entities"]["tp"] += tp_e
+    totals["entities"]["fp"] += fp_e
+    totals["entities"]["fn"] += fn_e
+
+    # Update global per-type entity counters
+    totals["per_type"] += per_type_e_row
+
+    # Row-level entity PRF
+    p_e, r_e, f1_e = compute_prf1(tp_e, fp_e, fn_e)
+
+    # ========================================================
+    # RELATION SCORING (multiset intersection, like entities)
+    # ========================================================
+    rel_match = match_multisets(gold_rel, pred_rel)
+
+    tp_r, fp_r, fn_r = (sum(c.values()) for c in rel_match)
+
+    # Update global relation counters
+    totals["relations"]["tp"] += tp_r
+    totals["relations"]["fp"] += fp_r
+    totals["relations"]["fn"] += fn_r
+
+    # Row-level relation PRF
+    p_r, r_r, f1_r = compute_prf1(tp_r, fp_r, fn_r)
+
+    # ========================================================
+    # BUILD ROW RECORD (including per-type metrics)
+    # ========================================================
+    row_dict = {
+        "Row_ID": row_id,
+        "TP_entities": tp_e,
+        "FP_entities": fp_e,
+        "FN_entities": fn_e,
+        "Entity_Precision": p_e,
+        "Entity_Recall": r_e,
+        "Entity_F1": f1_e,
+        "TP_rel": tp_r,
+        "FP_rel": fp_r,
+        "FN_rel": fn_r,
+        "Rel_Precision": p_r,
+        "Rel_Recall": r_r,
+        "Rel_F1": f1_r,
+    }
+
+    # Add per-type entity metrics for this row
+    _, _, f1_types = compute_prf1_array(per_type_e_row)
+    for etype, (tp_t, fp_t, fn_t), f1_t in zip(ALL_ENTITY_TYPES, per_type_e_row.tolist(), f1_types.tolist()):
+        prefix = etype  # e.g., "person"
+        row_dict[f"{prefix}_TP"] = tp_t
+        row_dict[f"{prefix}_FP"] = fp_t
+        row_dict[f"{prefix}_FN"] = fn_t
+        row_dict[f"{prefix}_F1"] = f1_t
+
+    # ========================================================
+    # Detailed pairs (same multisets as the scores above)
+    # ========================================================
+    tp_entity_list, fp_entity_list, fn_entity_list = (
+        [str(e) for e in c.elements()] for c in entity_match
+    )
+    tp_rel_list, fp_rel_list, fn_rel_list = (
+        [str(r) for r in c.elements()] for c in rel_match
+    )
+
+    detailed_dict = {
+        "Row_ID": row_id,
+        "TP_entities": len(tp_entity_list),
+        "FP_entities": len(fp_entity_list),
+        "FN_entities": len(fn_entity_list),
+        "TP_rel": len(tp_rel_list),
+        "FP_rel": len(fp_rel_list),
+        "FN_rel": len(fn_rel_list),
+        "TP_entity_pairs": "; ".join(tp_entity_list),
+        "FP_entity_pairs": "; ".join(fp_entity_list),
+        "FN_entity_pairs": "; ".join(fn_entity_list),
+        "TP_relation_pairs": "; ".join(tp_rel_list),
+        "FP_relation_pairs": "; ".join(fp_rel_list),
+        "FN_relation_pairs": "; ".join(fn_rel_list),
+    }
+
+    return row_dict, detailed_dict
+
+
+def open_csv_writer(path, fieldnames):
+    fh = open(path, "w", newline="", encoding="utf-8")
+    writer = csv.DictWriter(fh, fieldnames=fieldnames, lineterminator="\n")
+    writer.writeheader()
+    return fh, writer
+
+
+def write_summary(output_summary, totals):
+    ent = totals["entities"]
+    rel = totals["relations"]
+    p_e, r_e, f1_e = compute_prf1(ent["tp"], ent["fp"], ent["fn"])
+    p_r, r_r, f1_r = compute_prf1(rel["tp"], rel["fp"], rel["fn"])
+
+    with open(output_summary, "w") as f:
+        f.write("===== GLOBAL SUMMARY =====\n")
+        f.write(f"Entities: TP={ent['tp']}, FP={ent['fp']}, FN={ent['fn']}\n")
+        f.write(f"P={p_e:.4f}, R={r_e:.4f}, F1={f1_e:.4f}\n\n")
+        f.write(f"Relations: TP={rel['tp']}, FP={rel['fp']}, FN={rel['fn']}\n")
+        f.write(f"P={p_r:.4f}, R={r_r:.4f}, F1={f1_r:.4f}\n")
+
+        # --------------------------------------------------------
+        # PER-TYPE ENTITY SUMMARY
+        # --------------------------------------------------------
+        f.write("\n===== PER-TYPE ENTITY SUMMARY =====\n")
+        per_type = totals["per_type"]
+        prf_types = zip(*(a.tolist() for a in compute_prf1_array(per_type)))
+        for etype, (tp_t, fp_t, fn_t), (p_t, r_t, f1_t) in zip(ALL_ENTITY_TYPES, per_type.tolist(), prf_types):
+
+            f.write(f"\n{etype.upper()}:\n")
+            f.write(f"  TP={tp_t}, FP={fp_t}, FN={fn_t}\n")
+            f.write(f"  P={p_t:.4f}, R={r_t:.4f}, F1={f1_t:.4f}\n")
+
+
 # ============================================================
 # MAIN
 # ============================================================
@@ -178,208 +439,78 @@ def main():
     detailed_csv = os.path.join(run_folder, "detailed_pairs.csv")
     logfile = os.path.join(run_folder, "evaluation_log.txt")
 
-    log("===== EVALUATION STARTED =====", logfile)
-    log(f"CSV Path = {args.csv_path}", logfile)
-    log(f"Run Folder = {run_folder}", logfile)
+    # Line-buffered so the log stays readable while the run is in progress
+    log_fh = open(logfile, "a", buffering=1)
+
+    log("===== EVALUATION STARTED =====", log_fh)
+    log(f"CSV Path = {args.csv_path}", log_fh)
+    log(f"Run Folder = {run_folder}", log_fh)
 
     overall_start = time.time()
 
-    df = pd.read_csv(args.csv_path)
+    df = csv_io.read_csv(args.csv_path)
 
     if "Sr.No." in df.columns:
         df["Row_ID"] = df["Sr.No."].astype(str)
     else:
         df["Row_ID"] = df.index.astype(str)
 
-    # Global overall counts for entities & relations
-    global_tp_e = global_fp_e = global_fn_e = 0
-    global_tp_r = global_fp_r = global_fn_r = 0
+    # Global overall + per-type counts for entities & relations
+    totals = new_totals()
 
-    # Global per-type entity counts
-    global_per_type_entities: Dict[str, Dict[str, int]] = {
-        etype: {"tp": 0, "fp": 0, "fn": 0} for etype in ALL_ENTITY_TYPES
-    }
+    # Rows are written out as soon as they are scored
+    row_eval_fh, row_writer = open_csv_writer(output_results, ROW_EVAL_FIELDS)
+    detailed_fh, detailed_writer = open_csv_writer(detailed_csv, DETAILED_FIELDS)
 
-    row_records = []
-    detailed_rows = []
+    # ============================================================
+    # PARSE (whole columns at once)
+    # ============================================================
+    # Entity types allowed for each row (from CSV)
+    allowed_col = df["Entity_Types"].astype(str).map(
+        lambda s: [t.strip() for t in s.split(",") if t.strip()]
+    )
+    gold_parsed = parse_delimited_column(df["Output"], allowed_col)
+    pred_parsed = parse_delimited_column(df["LLM_Output"], allowed_col)
 
     # ============================================================
     # LOOP
     # ============================================================
-    for idx, row in df.iterrows():
-        row_id = row["Row_ID"]
+    # Plain arrays avoid boxing every row into a Series (iterrows)
+    row_ids = df["Row_ID"].to_numpy()
+
+    for pos, row_id in enumerate(row_ids):
         t0 = time.time()
 
-        log(f"Processing Row_ID={row_id} ...", logfile)
-
-        # Entity types allowed for this row (from CSV)
-        allowed_types = [t.strip() for t in str(row["Entity_Types"]).split(",") if t.strip()]
-
-        gold = parse_delimited_output(row["Output"], allowed_types)
-        pred = parse_delimited_output(row["LLM_Output"], allowed_types)
-
-        gold_entities = gold["entities"]
-        pred_entities = pred["entities"]
-        gold_rel = gold["relations"]
-        pred_rel = pred["relations"]
-
-        log(f"  GOLD: {len(gold_entities)} entities, {len(gold_rel)} relations", logfile)
-        log(f"  PRED: {len(pred_entities)} entities, {len(pred_rel)} relations", logfile)
-
-        # ========================================================
-        # ENTITY SCORING (GLOBAL + PER-TYPE)
-        # ========================================================
-        overall_e, per_type_e_row = score_entities(gold_entities, pred_entities)
-
-        tp_e = overall_e["tp"]
-        fp_e = overall_e["fp"]
-        fn_e = overall_e["fn"]
-
-        # Update global overall entity counters
-        global_tp_e += tp_e
-        global_fp_e += fp_e
-        global_fn_e += fn_e
-
-        # Update global per-type entity counters
-        for etype, counts in per_type_e_row.items():
-            if etype not in global_per_type_entities:
-                global_per_type_entities[etype] = {"tp": 0, "fp": 0, "fn": 0}
-            global_per_type_entities[etype]["tp"] += counts["tp"]
-            global_per_type_entities[etype]["fp"] += counts["fp"]
-            global_per_type_entities[etype]["fn"] += counts["fn"]
-
-        # Row-level entity PRF
-        p_e, r_e, f1_e = compute_prf1(tp_e, fp_e, fn_e)
-
-        # ========================================================
-        # RELATION SCORING (same as your original logic)
-        # ========================================================
-        gold_rel_used = [False] * len(gold_rel)
-        tp_r = fp_r = fn_r = 0
-
-        for pr in pred_rel:
-            if pr in gold_rel:
-                m = gold_rel.index(pr)
-                if not gold_rel_used[m]:
-                    tp_r += 1
-                    gold_rel_used[m] = True
-                else:
-                    fp_r += 1
-            else:
-                fp_r += 1
-
-        fn_r = gold_rel_used.count(False)
-
-        # Update global relation counters
-        global_tp_r += tp_r
-        global_fp_r += fp_r
-        global_fn_r += fn_r
-
-        # Row-level relation PRF
-        p_r, r_r, f1_r = compute_prf1(tp_r, fp_r, fn_r)
-
-        # ========================================================
-        # BUILD ROW RECORD (including per-type metrics)
-        # ========================================================
-        row_dict = {
-            "Row_ID": row_id,
-            "TP_entities": tp_e,
-            "FP_entities": fp_e,
-            "FN_entities": fn_e,
-            "Entity_Precision": p_e,
-            "Entity_Recall": r_e,
-            "Entity_F1": f1_e,
-            "TP_rel": tp_r,
-            "FP_rel": fp_r,
-            "FN_rel": fn_r,
-            "Rel_Precision": p_r,
-            "Rel_Recall": r_r,
-            "Rel_F1": f1_r,
-        }
-
-        # Add per-type entity metrics for this row
-        for etype in ALL_ENTITY_TYPES:
-            counts = per_type_e_row.get(etype, {"tp": 0, "fp": 0, "fn": 0})
-            tp_t = counts["tp"]
-            fp_t = counts["fp"]
-            fn_t = counts["fn"]
-            p_t, r_t, f1_t = compute_prf1(tp_t, fp_t, fn_t)
-
-            prefix = etype  # e.g., "person"
-            row_dict[f"{prefix}_TP"] = tp_t
-            row_dict[f"{prefix}_FP"] = fp_t
-            row_dict[f"{prefix}_FN"] = fn_t
-            row_dict[f"{prefix}_F1"] = f1_t
-
-        row_records.append(row_dict)
-
-        # ========================================================
-        # Detailed pairs (unchanged logic)
-        # ========================================================
-        tp_entity_list = [str(pe) for pe in pred_entities if pe in gold_entities]
-        fp_entity_list = [str(pe) for pe in pred_entities if pe not in gold_entities]
-        fn_entity_list = [str(ge) for ge in gold_entities if ge not in pred_entities]
-
-        tp_rel_list = [str(pr) for pr in pred_rel if pr in gold_rel]
-        fp_rel_list = [str(pr) for pr in pred_rel if pr not in gold_rel]
-        fn_rel_list = [str(gr) for gr in gold_rel if gr not in pred_rel]
-
-        detailed_rows.append({
-            "Row_ID": row_id,
-            "TP_entities": len(tp_entity_list),
-            "FP_entities": len(fp_entity_list),
-            "FN_entities": len(fn_entity_list),
-            "TP_rel": len(tp_rel_list),
-            "FP_rel": len(fp_rel_list),
-            "FN_rel": len(fn_rel_list),
-            "TP_entity_pairs": "; ".join(tp_entity_list),
-            "FP_entity_pairs": "; ".join(fp_entity_list),
-            "FN_entity_pairs": "; ".join(fn_entity_list),
-            "TP_relation_pairs": "; ".join(tp_rel_list),
-            "FP_relation_pairs": "; ".join(fp_rel_list),
-            "FN_relation_pairs": "; ".join(fn_rel_list),
-        })
+        log(f"Processing Row_ID={row_id} ...", log_fh)
+
+        gold = gold_parsed[pos]
+        pred = pred_parsed[pos]
+
+        log(f"  GOLD: {len(gold['entities'])} entities, {len(gold['relations'])} relations", log_fh)
+        log(f"  PRED: {len(pred['entities'])} entities, {len(pred['relations'])} relations", log_fh)
+
+        row_dict, detailed_dict = evaluate_row(row_id, gold, pred, totals)
+        row_writer.writerow(row_dict)
+        detailed_writer.writerow(detailed_dict)
 
         dt = time.time() - t0
-        log(f"Finished Row_ID={row_id} in {dt:.3f} sec", logfile)
+        log(f"Finished Row_ID={row_id} in {dt:.3f} sec", log_fh)
 
     # ============================================================
-    # Save files into timestamped folder
+    # Finish the streamed CSVs in the timestamped folder
     # ============================================================
-    pd.DataFrame(row_records).to_csv(output_results, index=False)
-    pd.DataFrame(detailed_rows).to_csv(detailed_csv, index=False)
+    row_eval_fh.close()
+    detailed_fh.close()
 
     # ============================================================
     # GLOBAL SUMMARY
     # ============================================================
-    p_e, r_e, f1_e = compute_prf1(global_tp_e, global_fp_e, global_fn_e)
-    p_r, r_r, f1_r = compute_prf1(global_tp_r, global_fp_r, global_fn_r)
-
-    with open(output_summary, "w") as f:
-        f.write("===== GLOBAL SUMMARY =====\n")
-        f.write(f"Entities: TP={global_tp_e}, FP={global_fp_e}, FN={global_fn_e}\n")
-        f.write(f"P={p_e:.4f}, R={r_e:.4f}, F1={f1_e:.4f}\n\n")
-        f.write(f"Relations: TP={global_tp_r}, FP={global_fp_r}, FN={global_fn_r}\n")
-        f.write(f"P={p_r:.4f}, R={r_r:.4f}, F1={f1_r:.4f}\n")
-
-        # --------------------------------------------------------
-        # PER-TYPE ENTITY SUMMARY
-        # --------------------------------------------------------
-        f.write("\n===== PER-TYPE ENTITY SUMMARY =====\n")
-        for etype in ALL_ENTITY_TYPES:
-            g_counts = global_per_type_entities.get(etype, {"tp": 0, "fp": 0, "fn": 0})
-            tp_t = g_counts["tp"]
-            fp_t = g_counts["fp"]
-            fn_t = g_counts["fn"]
-            p_t, r_t, f1_t = compute_prf1(tp_t, fp_t, fn_t)
-
-            f.write(f"\n{etype.upper()}:\n")
-            f.write(f"  TP={tp_t}, FP={fp_t}, FN={fn_t}\n")
-            f.write(f"  P={p_t:.4f}, R={r_t:.4f}, F1={f1_t:.4f}\n")
+    write_summary(output_summary, totals)
 
     total = time.time() - overall_start
-    log(f"===== EVALUATION COMPLETE in {total:.2f} sec =====", logfile)
-    log(f"Saved results in: {run_folder}", logfile)
+    log(f"===== EVALUATION COMPLETE in {total:.2f} sec =====", log_fh)
+    log(f"Saved results in: {run_folder}", log_fh)
+    log_fh.close()
 
 
 if __name__ == "__main__":
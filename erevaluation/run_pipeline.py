@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import aiohttp
+import time
+import os
+from datetime import datetime
+
+import csv_io
+import erevaluation
+import evaluation2
+
+# ------------------------
+# FUSED INFERENCE + SCORING
+# ------------------------
+# Each row is parsed and scored as soon as its Ollama response arrives, so the
+# LLM outputs never need to go through an intermediate CSV. Rows are written to
+# row_eval.csv / detailed_pairs.csv in completion order (Row_ID identifies them).
+async def run_and_score(df, row_ids, PROMPT_TEMPLATE, args, ollama_url, run_folder, log_fh):
+    prompts = erevaluation.build_prompts(df, PROMPT_TEMPLATE)
+    entity_types = df["Entity_Types"].to_numpy()
+    gold_outputs = df["Output"].to_numpy()
+    allowed_types = [
+        [t.strip() for t in str(types).split(",") if t.strip()]
+        for types in entity_types
+    ]
+
+    totals = evaluation2.new_totals()
+    raw_outputs = [None] * len(df) if args.dump_raw else None
+
+    row_eval_fh, row_writer = evaluation2.open_csv_writer(
+        os.path.join(run_folder, "row_eval.csv"), evaluation2.ROW_EVAL_FIELDS)
+    detailed_fh, detailed_writer = evaluation2.open_csv_writer(
+        os.path.join(run_folder, "detailed_pairs.csv"), evaluation2.DETAILED_FIELDS)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession(connector=erevaluation.make_connector(args)) as session:
+        await erevaluation.warm_up_model(session, args, ollama_url)
+
+        async def infer(i):
+            llm_output = await erevaluation.process_row(
+                session, semaphore, i, len(df), prompts[i], entity_types[i], args, ollama_url
+            )
+            return i, llm_output
+
+        tasks = [asyncio.ensure_future(infer(i)) for i in range(len(df))]
+
+        for next_done in asyncio.as_completed(tasks):
+            i, llm_output = await next_done
+
+            gold = evaluation2.parse_delimited_output(gold_outputs[i], allowed_types[i])
+            pred = evaluation2.parse_delimited_output(llm_output, allowed_types[i])
+
+            row_dict, detailed_dict = evaluation2.evaluate_row(row_ids[i], gold, pred, totals)
+            row_writer.writerow(row_dict)
+            detailed_writer.writerow(detailed_dict)
+
+            evaluation2.log(
+                f"Scored Row_ID={row_ids[i]}: "
+                f"{len(gold['entities'])}/{len(pred['entities'])} gold/pred entities, "
+                f"{len(gold['relations'])}/{len(pred['relations'])} gold/pred relations",
+                log_fh
+            )
+
+            if raw_outputs is not None:
+                raw_outputs[i] = llm_output
+
+    row_eval_fh.close()
+    detailed_fh.close()
+
+    return totals, raw_outputs
+
+
+# ------------------------
+# MAIN PIPELINE
+# ------------------------
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Run LLM extraction on CSV rows and score each row as soon as it completes."
+    )
+    parser.add_argument("--csv_path", type=str, required=True,
+                        help="Path to input CSV file (with gold Output column).")
+    parser.add_argument("--prompt_path", type=str, required=True,
+                        help="Path to the full prompt text file.")
+    parser.add_argument("--model_name", type=str, required=True,
+                        help="Ollama model name.")
+    parser.add_argument("--ollama_host", type=str, required=True,
+                        help="Ollama host, e.g. 127.0.0.1:11434")
+    parser.add_argument("--timeout", type=int, default=300,
+                        help="Timeout for Ollama call (default 300s).")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Limit number of rows to process (optional)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Max concurrent Ollama requests (default 4).")
+    parser.add_argument("--keep_alive", type=str, default="1h",
+                        help="How long Ollama keeps the model loaded between requests (default 1h).")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="Base directory where timestamped run folder will be created.")
+    parser.add_argument("--dump_raw", action="store_true",
+                        help="Also save the input CSV with an LLM_Output column (llm_outputs.csv).")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    ollama_url = f"http://{args.ollama_host}/api/generate"
+
+    timestamp = datetime.now().strftime("run_%Y-%m-%d_%H-%M-%S")
+    run_folder = os.path.join(args.output_dir, timestamp)
+    os.makedirs(run_folder, exist_ok=True)
+
+    # Line-buffered so the log stays readable while the run is in progress
+    log_fh = open(os.path.join(run_folder, "evaluation_log.txt"), "a", buffering=1)
+
+    evaluation2.log("===== PIPELINE STARTED =====", log_fh)
+    evaluation2.log(f"CSV Path = {args.csv_path}", log_fh)
+    evaluation2.log(f"Run Folder = {run_folder}", log_fh)
+
+    overall_start = time.time()
+
+    with open(args.prompt_path, "r", encoding="utf-8") as f:
+        PROMPT_TEMPLATE = f.read()
+
+    df = csv_io.read_csv(args.csv_path)
+    if args.limit:
+        df = df.head(args.limit)
+
+    if "Sr.No." in df.columns:
+        row_ids = df["Sr.No."].astype(str).to_numpy()
+    else:
+        row_ids = df.index.astype(str).to_numpy()
+
+    totals, raw_outputs = asyncio.run(
+        run_and_score(df, row_ids, PROMPT_TEMPLATE, args, ollama_url, run_folder, log_fh)
+    )
+
+    evaluation2.write_summary(os.path.join(run_folder, "summary.txt"), totals)
+
+    if raw_outputs is not None:
+        df["LLM_Output"] = raw_outputs
+        csv_io.write_csv(df, os.path.join(run_folder, "llm_outputs.csv"))
+
+    total = time.time() - overall_start
+    evaluation2.log(f"===== PIPELINE COMPLETE in {total:.2f} sec =====", log_fh)
+    evaluation2.log(f"Saved results in: {run_folder}", log_fh)
+    log_fh.close()
+
+
+# ------------------------
+# ENTRY POINT
+# ------------------------
+if __name__ == "__main__":
+    main()
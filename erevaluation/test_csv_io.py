@@ -0,0 +1,23 @@
+import pandas as pd
+
+import csv_io
+
+
+def test_read_csv_multiline_cells_over_one_block(tmp_path):
+    # Larger than pyarrow's default 1 MB block, with newlines inside quoted cells
+    cell = '("entity"{tuple_delimiter}A{tuple_delimiter}PERSON)\n{record_delimiter}\n("entity", "B")'
+    n_rows = 20000
+    df = pd.DataFrame({
+        "Sr.No.": range(1, n_rows + 1),
+        "Entity_Types": ["PERSON, LOCATION"] * n_rows,
+        "Input_Text": ["Some input text,\nspanning two lines."] * n_rows,
+        "Output": [cell] * n_rows,
+        "LLM_Output": [cell] * n_rows,
+    })
+    path = tmp_path / "big.csv"
+    df.to_csv(path, index=False)
+    assert path.stat().st_size > 1 << 20
+
+    result = csv_io.read_csv(str(path))
+
+    pd.testing.assert_frame_equal(result, pd.read_csv(path), check_dtype=False)
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from evaluation2 import parse_delimited_column, parse_delimited_output
+
+
+def test_parse_delimited_column_all_nan():
+    # An all-empty LLM_Output column is read as float64 NaN
+    raw = pd.Series([np.nan, np.nan], dtype="float64")
+    allowed = pd.Series([["PERSON"], ["LOCATION"]])
+
+    assert parse_delimited_column(raw, allowed) == [
+        {"entities": [], "relations": []},
+        {"entities": [], "relations": []},
+    ]
+
+
+def test_parse_delimited_column_matches_row_parser():
+    row = (
+        '("entity"{tuple_delimiter}John Smith{tuple_delimiter}PERSON{tuple_delimiter}a man)'
+        '{record_delimiter}("entity"{tuple_delimiter}Texas{tuple_delimiter}LOCATION{tuple_delimiter}a state)'
+        '{record_delimiter}("relationship"{tuple_delimiter}John Smith{tuple_delimiter}Texas{tuple_delimiter}lives in)'
+        '{completion_delimiter}'
+    )
+    raw = pd.Series([row, np.nan])
+    allowed = pd.Series([["PERSON"], ["PERSON"]])
+
+    expected = [parse_delimited_output(r, a) for r, a in zip(raw, allowed)]
+    assert parse_delimited_column(raw, allowed) == expected
@@ -0,0 +1,24 @@
+import asyncio
+
+import erevaluation
+import run_pipeline
+
+
+def test_make_connector_accepts_run_pipeline_args():
+    args = run_pipeline.build_parser().parse_args([
+        "--csv_path", "in.csv",
+        "--prompt_path", "prompt.txt",
+        "--model_name", "m",
+        "--ollama_host", "127.0.0.1:11434",
+        "--output_dir", "out",
+        "--concurrency", "3",
+    ])
+
+    async def build():
+        connector = erevaluation.make_connector(args)
+        try:
+            return connector.limit
+        finally:
+            await connector.close()
+
+    assert asyncio.run(build()) == 3
@@ -1,34 +1,62 @@
 import argparse
 import re
 import os
+import mmap
 import json
 from datetime import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logutil import get_file_logger
+
 log_file = None  # Will be set dynamically
 
+# Paragraphs are separated by one or more blank lines
+PARA_SPLIT_RE = re.compile(r'\n{2,}')
+PARA_SPLIT_BYTES_RE = re.compile(rb'(?:\r?\n){2,}')
+
 def log(msg):
     time_stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     full_msg = f"[{time_stamp}] {msg}"
     print(full_msg)
     if log_file:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(full_msg + '\n')
+        get_file_logger(log_file).info(full_msg)
+
+def read_paragraphs(path):
+    # Split straight from an mmap of the file so the whole case is never
+    # decoded into one str (plus its stripped copy) before splitting
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return [
+                para.decode('utf-8').replace('\r\n', '\n')
+                for para in PARA_SPLIT_BYTES_RE.split(mm)
+            ]
 
 def chunk_legal_text(text, max_tokens=2000, tokenizer=None, min_last_chunk_words=20):
-    paragraphs = re.split(r'\n{2,}', text.strip())
+    paragraphs = PARA_SPLIT_RE.split(text.strip())
+    return chunk_paragraphs(paragraphs, max_tokens, tokenizer, min_last_chunk_words)
+
+def chunk_paragraphs(paragraphs, max_tokens=2000, tokenizer=None, min_last_chunk_words=20):
     chunks = []
     current_chunk = []
     current_length = 0
     #log(f"Number of paragraphs: {len(paragraphs)}")
     #log(f"First paragraph (truncated): {paragraphs[0][:100] if paragraphs else 'None'}")
     
-    for para in paragraphs:
-        para = para.strip()
-        if not para:
-            continue
-
-        token_count = len(tokenizer.encode(para)) if tokenizer else len(para.split())
-
+    paragraphs = [para.strip() for para in paragraphs]
+    paragraphs = [para for para in paragraphs if para]
+
+    if tokenizer is None:
+        token_counts = [len(para.split()) for para in paragraphs]
+    elif hasattr(tokenizer, "encode_batch"):
+        # tiktoken: encode every paragraph in one call into the Rust BPE
+        token_counts = [len(ids) for ids in tokenizer.encode_batch(paragraphs, disallowed_special=())]
+    else:
+        token_counts = [len(tokenizer.encode(para)) for para in paragraphs]
+
+    for para, token_count in zip(paragraphs, token_counts):
         if current_length + token_count > max_tokens:
             if current_chunk:
                 chunks.append("\n\n".join(current_chunk))
@@ -37,10 +65,12 @@ def chunk_legal_text(text, max_tokens=2000, tokenizer=None, min_last_chunk_words
         else:
             current_chunk.append(para)
             current_length += token_count
-    print(chunks)
     if current_chunk:
         chunks.append("\n\n".join(current_chunk))
 
+    if chunks and os.environ.get("CHUNK_DEBUG"):
+        log(f"Built {len(chunks)} chunks, first={chunks[0][:80]!r}")
+
     if len(chunks) >= 2:
         last_chunk_words = len(chunks[-1].split())
         if last_chunk_words < min_last_chunk_words:
@@ -50,7 +80,12 @@ def chunk_legal_text(text, max_tokens=2000, tokenizer=None, min_last_chunk_words
 
     return chunks
 
-def main():
+def write_chunk_file(pair):
+    chunk_path, data = pair
+    with open(chunk_path, 'wb', buffering=1 << 20) as out_file:
+        out_file.write(data)
+
+def main(argv=None):
     global log_file
     start_time = time.time()
 
@@ -60,7 +95,7 @@ def main():
     parser.add_argument("--max-tokens", type=int, default=2000, help="Max tokens per chunk")
     parser.add_argument("--min-last-chunk-words", type=int, default=20, help="Minimum words for last chunk before merging")
     parser.add_argument("--use-tokenizer", action="store_true", help="Use GPT-2 tokenizer for token count")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     log_file = os.path.join(os.path.dirname(args.output_dir), "log.txt")
     log(f"Starting chunking for {args.input_file}...")
@@ -68,28 +103,37 @@ def main():
     tokenizer = None
     if args.use_tokenizer:
         try:
-            from transformers import AutoTokenizer
-            log("Loading GPT-2 tokenizer...")
-            tokenizer = AutoTokenizer.from_pretrained("gpt2")
+            import tiktoken
+            log("Loading GPT-2 tokenizer (tiktoken)...")
+            tokenizer = tiktoken.get_encoding("gpt2")
         except ImportError:
-            log("Transformers library is not installed. Run: pip install transformers")
-            return
-
-    with open(args.input_file, 'r', encoding='utf-8') as f:
-        text = f.read()
-
-    chunks = chunk_legal_text(
-        text,
+            # Same GPT-2 vocabulary, just slower to load and to encode
+            try:
+                from transformers import AutoTokenizer
+                log("Loading GPT-2 tokenizer...")
+                tokenizer = AutoTokenizer.from_pretrained("gpt2")
+            except ImportError:
+                log("No tokenizer library is installed. Run: pip install tiktoken")
+                return
+
+    paragraphs = read_paragraphs(args.input_file)
+
+    chunks = chunk_paragraphs(
+        paragraphs,
         max_tokens=args.max_tokens,
         tokenizer=tokenizer,
         min_last_chunk_words=args.min_last_chunk_words
     )
 
-    for i, chunk in enumerate(chunks):
-        chunk_path = os.path.join(args.output_dir, f"chunk_{i+1:02d}.txt")  # zero-padded to 2 digits
-        with open(chunk_path, 'w', encoding='utf-8') as out_file:
-            out_file.write(chunk)
-        log(f"Saved chunk {i+1:02d} ({len(chunk.split())} words)")
+    pairs = [
+        (os.path.join(args.output_dir, f"chunk_{i+1:02d}.txt"), chunk.encode('utf-8'))  # zero-padded to 2 digits
+        for i, chunk in enumerate(chunks)
+    ]
+    # Overlap the open/write/close round-trips, which dominate on networked
+    # storage; 8 workers keeps the number of open descriptors small
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(write_chunk_file, pairs))
+    log(f"Saved {len(pairs)} chunks ({sum(len(data) for _, data in pairs)} bytes)")
 
     end_time = time.time()
     log(f"Successfully created {len(chunks)} chunks in '{args.output_dir}'.")
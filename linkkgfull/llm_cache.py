@@ -0,0 +1,45 @@
+import os
+import json
+import time
+import hashlib
+
+# Responses are cached per (model, prompt); Ollama is called without sampling
+# options, so re-running a stage on the same input yields the same prompts.
+CACHE_DIR = os.path.join("output", ".llm_cache")
+DEFAULT_TTL = 7 * 24 * 3600  # seconds
+
+
+def cache_key(model_name, prompt):
+    payload = json.dumps({"model": model_name, "prompt": prompt}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_path(key, cache_dir):
+    return os.path.join(cache_dir, key[:2], key + ".json")
+
+
+def get(model_name, prompt, ttl=DEFAULT_TTL, cache_dir=CACHE_DIR):
+    """Return the cached response, or None on a miss or an expired entry."""
+    path = _cache_path(cache_key(model_name, prompt), cache_dir)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - entry.get("ts", 0) >= ttl:
+        return None
+    return entry.get("response")
+
+
+def put(model_name, prompt, response, cache_dir=CACHE_DIR):
+    path = _cache_path(cache_key(model_name, prompt), cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    entry = {"prompt_len": len(prompt), "response": response, "ts": time.time()}
+
+    # Write to a temp file and rename so concurrent readers never see a partial entry
+    tmp_path = f"{path}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
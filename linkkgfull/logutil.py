@@ -0,0 +1,50 @@
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+
+_lock = threading.Lock()
+_listeners = []
+
+
+def get_file_logger(path):
+    """
+    Logger appending to `path`. Records go through a QueueHandler to a
+    background QueueListener that owns the file, so log() callers (including
+    the retry loops in worker threads) never wait on disk writes. The file is
+    opened on the first record and then kept open.
+    Loggers are shared per path: stages run in-process by the pipeline that
+    write the same log.txt reuse one listener, and lines from worker threads
+    stay intact because only the listener thread writes.
+    """
+    path = os.path.abspath(path)
+    logger = logging.getLogger(f"linkkg.log:{path}")
+    if not logger.handlers:
+        with _lock:
+            if not logger.handlers:
+                handler = logging.FileHandler(path, mode='a', encoding='utf-8', delay=True)
+                # log() callers already add the timestamp
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                records = queue.SimpleQueue()
+                listener = logging.handlers.QueueListener(records, handler)
+                listener.start()
+                queue_handler = logging.handlers.QueueHandler(records)
+                _listeners.append((logger, queue_handler, listener))
+                logger.addHandler(queue_handler)
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+    return logger
+
+
+@atexit.register
+def flush_logs():
+    """Write out every queued record and stop the listener threads."""
+    with _lock:
+        while _listeners:
+            logger, queue_handler, listener = _listeners.pop()
+            logger.removeHandler(queue_handler)
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
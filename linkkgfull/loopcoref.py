@@ -2,30 +2,211 @@ import os
 import argparse
 import json
 import requests
+import urllib3
 from datetime import datetime
+from functools import lru_cache
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    # orjson is optional; fall back to the stdlib encoder
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+import llm_cache
+from logutil import get_file_logger
+
+# Pooled keep-alive connections to Ollama, shared by every inference call and
+# by the --concurrency worker threads
+_SESSION = requests.Session()
+_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+_SESSION_HEADERS = {"Content-Type": "application/json"}
+
+
+def close_session():
+    _SESSION.close()
+
+# Ceiling, in seconds, for the exponential backoff between retries
+MAX_BACKOFF = 60
+
+
+class RetryableError(Exception):
+    """Ollama failed in a way worth retrying (timeout, connection, 5xx, 429)."""
+
+
+class InferenceTimeout(RetryableError):
+    pass
+
+
+class FatalError(Exception):
+    """Ollama rejected the request (4xx other than 429); retrying will not help."""
+
+class BackendPool:
+    """
+    Routes each request to the Ollama backend with the fewest requests in
+    flight. A backend that times out `max_failures` times in a row is skipped
+    for `cooldown` seconds, unless every backend is cooling down.
+    """
+
+    def __init__(self, urls, max_failures=2, cooldown=60):
+        self.urls = list(urls)
+        self.in_flight = {url: 0 for url in self.urls}
+        self.failures = {url: 0 for url in self.urls}
+        self.down_until = {url: 0.0 for url in self.urls}
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            healthy = [url for url in self.urls if self.down_until[url] <= now] or self.urls
+            # Ties go to the backend listed first, so one backend behaves as before
+            url = min(healthy, key=lambda u: self.in_flight[u])
+            self.in_flight[url] += 1
+            return url
+
+    def release(self, url, timed_out=False):
+        with self.lock:
+            self.in_flight[url] -= 1
+            if not timed_out:
+                self.failures[url] = 0
+                return
+            self.failures[url] += 1
+            if self.failures[url] >= self.max_failures:
+                self.down_until[url] = time.time() + self.cooldown
+                self.failures[url] = 0
+                log(f"Backend {url} timed out repeatedly; skipping it for {self.cooldown} seconds.")
+
+class MemoryLog:
+    """
+    Write-ahead log of the memory (memory.jsonl). After each chunk is merged,
+    one line is appended with only the entries that chunk added or changed, so
+    progress is on disk without re-serializing the whole memory every chunk.
+    final_memory.json is rebuilt from the in-memory dicts once, at the end.
+
+    With resume=True the existing log is replayed instead of truncated: a torn
+    last line (crash mid-write) is dropped, and done() reports which chunks of
+    which pass are already merged.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = []
+        if resume and os.path.exists(path):
+            valid_bytes = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n") or not isinstance(entry, dict) or "chunk" not in entry:
+                        break
+                    self.entries.append(entry)
+                    valid_bytes += len(line)
+            self.f = open(path, 'a', encoding='utf-8')
+            self.f.truncate(valid_bytes)
+        else:
+            self.f = open(path, 'w', encoding='utf-8')
+        self.completed = {(entry.get("pass"), entry["chunk"]) for entry in self.entries}
+
+    def replay(self, resolved_entities, aux_descriptions):
+        for entry in self.entries:
+            resolved_entities.update(entry.get("RESOLVED_ENTITIES", {}))
+            aux_descriptions.update(entry.get("AUXILIARY_DESCRIPTIONS", {}))
+        return len(self.entries)
+
+    def done(self, pass_label, chunk_name):
+        return (pass_label, chunk_name) in self.completed
+
+    def append(self, pass_label, chunk_name, new_resolved, new_aux):
+        self.f.write(json.dumps({
+            "pass": pass_label,
+            "chunk": chunk_name,
+            "RESOLVED_ENTITIES": new_resolved,
+            "AUXILIARY_DESCRIPTIONS": new_aux
+        }, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+# JSON schemas for --format schema (Ollama 0.5+ constrains the reply to them)
+MEMORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "RESOLVED_ENTITIES": {"type": "object"},
+        "AUXILIARY_DESCRIPTIONS": {"type": "object"}
+    },
+    "required": ["RESOLVED_ENTITIES", "AUXILIARY_DESCRIPTIONS"]
+}
+BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "CHUNKS": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": dict(MEMORY_SCHEMA["properties"], CHUNK_ID={"type": "string"}),
+                "required": ["CHUNK_ID", "RESOLVED_ENTITIES", "AUXILIARY_DESCRIPTIONS"]
+            }
+        }
+    },
+    "required": ["CHUNKS"]
+}
+
+def response_format(args, batched=False):
+    """The Ollama "format" value for --format: None, "json" or a JSON schema."""
+    if args.format == "schema":
+        return BATCH_SCHEMA if batched else MEMORY_SCHEMA
+    return args.format
+
+# Appended to the coref template when several chunks share one call (--chunks-per-call > 1)
+BATCH_INSTRUCTIONS = (
+    "The input below contains several text chunks in CHUNKS, in document order. "
+    "Apply the instructions above to each chunk in turn; RESOLVED_ENTITIES and "
+    "AUXILIARY_DESCRIPTIONS are the memory shared by all of them.\n"
+    "Return ONLY a JSON object of this form, with one entry per input chunk:\n\n"
+    "{\n"
+    "  \"CHUNKS\": [\n"
+    "    {\"CHUNK_ID\": \"<CHUNK_ID from the input>\", \"RESOLVED_ENTITIES\": {...}, \"AUXILIARY_DESCRIPTIONS\": {...}}\n"
+    "  ]\n"
+    "}\n\n"
+)
 
 def log(msg, log_file_path=None):
     time_stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     full_msg = f"[{time_stamp}] {msg}"
     print(full_msg)
     if log_file_path:
-        with open(log_file_path, "a", encoding="utf-8") as log_file:
-            log_file.write(full_msg + "\n")
+        get_file_logger(log_file_path).info(full_msg)
 
 def extract_json_from_ollama(raw_response):
     cleaned = raw_response.strip()
-    if not cleaned.startswith("{"):
-        raise ValueError(f"Output does not start with '{{'. Unexpected format:\n{cleaned[:200]}")
-
     try:
         result = json.loads(cleaned)
-        if "RESOLVED_ENTITIES" not in result or "AUXILIARY_DESCRIPTIONS" not in result:
-            raise ValueError("Valid JSON but missing required keys.")
-        return result
     except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON format. {e}")
+        raise ValueError(f"Invalid JSON format. {e}. Unexpected format:\n{cleaned[:200]}")
+
+    if not isinstance(result, dict) or "RESOLVED_ENTITIES" not in result or "AUXILIARY_DESCRIPTIONS" not in result:
+        raise ValueError("Valid JSON but missing required keys.")
+    return result
 
+# Templates are read once per process, even when pipeline stages run in-process
+@lru_cache(maxsize=16)
 def load_prompt_template(path):
     with open(path, 'r', encoding='utf-8') as f:
         return f.read()
@@ -41,31 +222,143 @@ def run_ollama_inference(prompt, model, url):
     return response.json()['response']
 '''
 
-def run_ollama_inference(prompt, model, url, timeout=120):
+def read_streamed_response(response):
+    """
+    Join the "response" fragments of a streamed Ollama reply.
+
+    Reading stops as soon as the first top-level {...} object is complete, or
+    as soon as the reply starts with anything but '{' (extract_json_from_ollama
+    would reject it anyway), so a bad generation fails without waiting for the
+    model to finish. Closing the connection early also stops the generation.
+    """
+    parts = []
+    started = False
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for line in response.iter_lines():
+        if not line:
+            continue
+        message = json.loads(line)
+        if "error" in message:
+            raise RetryableError(f"Ollama stream error: {message['error']}")
+
+        fragment = message.get("response", "")
+        for i, ch in enumerate(fragment):
+            if not started:
+                if ch.isspace():
+                    continue
+                if ch != "{":
+                    parts.append(fragment[:i + 1])
+                    return "".join(parts)
+                started = True
+
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    parts.append(fragment[:i + 1])
+                    return "".join(parts)
+
+        parts.append(fragment)
+        if message.get("done"):
+            break
+
+    return "".join(parts)
+
+def request_body(prompt, model, stream, keep_alive, fmt, options=None):
+    body = {
+        "model": model,
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": keep_alive
+    }
+    if fmt is not None:
+        # Ollama then only emits valid JSON (matching the schema, if one is given)
+        body["format"] = fmt
+    if options:
+        body["options"] = options
+    return json_dumps(body)
+
+def round_up_pow2(n):
+    return 1 << max(0, n - 1).bit_length()
+
+def context_options(prompt, args, label, num_chunks=1):
+    """
+    With --auto-num-ctx, size the context window to this prompt: about 3.5
+    characters per token plus --num-predict output tokens per chunk, rounded up
+    to a power of two so only a few distinct sizes are ever requested (Ollama
+    reloads the model when num_ctx changes). Returns None otherwise.
+    """
+    if not args.auto_num_ctx:
+        return None
+
+    num_predict = args.num_predict * num_chunks
+    prompt_tokens = int(len(prompt) / 3.5) + 1
+    num_ctx = min(args.max_num_ctx, max(2048, round_up_pow2(prompt_tokens + num_predict)))
+    log(f"num_ctx={num_ctx} for {label} (~{prompt_tokens} prompt tokens, num_predict={num_predict})", args.log_file)
+    return {"num_ctx": num_ctx, "num_predict": num_predict}
+
+def run_ollama_inference(prompt, model, url, timeout=120, stream=False, keep_alive=None, fmt=None, options=None):
     try:
-        response = requests.post(
+        response = _SESSION.post(
             url,
-            json={
-                "model": model,
-                "prompt": prompt,
-                "stream": False
-            },
-            timeout=timeout  # Set timeout in seconds
+            data=request_body(prompt, model, stream, keep_alive, fmt, options),
+            headers=_SESSION_HEADERS,
+            # When streaming, the read timeout applies between tokens rather
+            # than to the whole generation
+            timeout=(10, timeout) if stream else timeout,  # Set timeout in seconds
+            stream=stream
         )
         response.raise_for_status()  # Raises an error for 4xx/5xx responses
-        return response.json()['response']
+        if not stream:
+            return response.json()['response']
+
+        try:
+            return read_streamed_response(response)
+        except ValueError:
+            raise RetryableError("Invalid streamed response received from Ollama.")
+        except requests.exceptions.ConnectionError as e:
+            # A read timeout while iterating the body is re-raised by requests
+            # as a ConnectionError wrapping urllib3's ReadTimeoutError
+            if e.args and isinstance(e.args[0], urllib3.exceptions.ReadTimeoutError):
+                raise InferenceTimeout("Ollama inference timed out.")
+            raise
+        finally:
+            response.close()
 
     except requests.exceptions.Timeout:
-        raise Exception("Ollama inference timed out.")
+        raise InferenceTimeout("Ollama inference timed out.")
 
     except requests.exceptions.HTTPError as http_err:
-        raise Exception(f"HTTP error occurred: {http_err} - {response.text}")
+        status = http_err.response.status_code
+        if status < 500 and status != 429:
+            raise FatalError(f"HTTP error occurred: {http_err} - {response.text}")
+        raise RetryableError(f"HTTP error occurred: {http_err} - {response.text}")
 
     except requests.exceptions.RequestException as req_err:
-        raise Exception(f"Request failed: {req_err}")
+        raise RetryableError(f"Request failed: {req_err}")
+
 
+def dump_payload(payload, compact=False):
+    # Compact JSON drops the indentation whitespace, which the model would
+    # otherwise read as prompt tokens
+    if compact:
+        return json_dumps(payload).decode("utf-8")
+    return json.dumps(payload, indent=2)
 
-def inject_prompt(prompt_template, resolved_entities, aux_descriptions, ner_entities, aux_current, chunk_text, verification=False):
+def inject_prompt(prompt_template, resolved_entities, aux_descriptions, ner_entities, aux_current, chunk_text, verification=False, compact=False):
     identified_entities = {
         "NER_ENTITIES": ner_entities,
         "PROPER_NOUN_DESCRIPTION": aux_current
@@ -78,25 +371,341 @@ def inject_prompt(prompt_template, resolved_entities, aux_descriptions, ner_enti
         "CHUNK_TEXT": chunk_text
     }
 
-    return prompt_template.strip() + "\n\n" + json.dumps(payload, indent=2)
+    # Ollama reuses the KV cache for the longest prefix shared with the previous
+    # request. The template comes first, byte for byte, followed by the memory:
+    # it only grows by appending keys, so consecutive chunks share the template
+    # and most of the memory. The chunk-specific fields stay at the end.
+    return prompt_template + "\n\n" + dump_payload(payload, compact)
+
+def inject_batch_prompt(prompt_template, resolved_entities, aux_descriptions, batch_items, compact=False):
+    chunks = [
+        {
+            "CHUNK_ID": chunk_name,
+            "IDENTIFIED_ENTITIES": {
+                "NER_ENTITIES": ner_entities,
+                "PROPER_NOUN_DESCRIPTION": aux_current
+            },
+            "CHUNK_TEXT": chunk_text
+        }
+        for chunk_name, chunk_text, ner_entities, aux_current in batch_items
+    ]
 
-def process_chunks(chunk_files, args, prompt_template, resolved_entities, aux_descriptions, verification=False):
-    for fname in chunk_files:
-        if not fname.endswith(".txt"):
-            continue
+    payload = {
+        "RESOLVED_ENTITIES": resolved_entities,
+        "AUXILIARY_DESCRIPTIONS": aux_descriptions,
+        "CHUNKS": chunks
+    }
 
-        chunk_name = fname.replace(".txt", "")
-        chunk_path = os.path.join(args.chunks_dir, fname)
-        ner_path = os.path.join(args.ner_dir, chunk_name + ".json")
+    return prompt_template + "\n\n" + BATCH_INSTRUCTIONS + dump_payload(payload, compact)
 
-        with open(chunk_path, 'r', encoding='utf-8') as f:
-            chunk_text = f.read()
-        with open(ner_path, 'r', encoding='utf-8') as f:
-            ner_data = json.load(f)
+def extract_batch_json_from_ollama(raw_response, chunk_names):
+    """Parse a batched reply and return one result per chunk, in the order of chunk_names."""
+    cleaned = raw_response.strip()
+    try:
+        result = json.loads(cleaned)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON format. {e}. Unexpected format:\n{cleaned[:200]}")
+
+    if not isinstance(result, dict) or not isinstance(result.get("CHUNKS"), list):
+        raise ValueError("Valid JSON but missing the CHUNKS list.")
+
+    by_id = {item.get("CHUNK_ID"): item for item in result["CHUNKS"] if isinstance(item, dict)}
+    missing = [name for name in chunk_names if name not in by_id]
+    if missing:
+        raise ValueError(f"Batched reply is missing chunks: {missing}")
+
+    results = []
+    for name in chunk_names:
+        item = by_id[name]
+        if "RESOLVED_ENTITIES" not in item or "AUXILIARY_DESCRIPTIONS" not in item:
+            raise ValueError(f"Valid JSON but missing required keys for {name}.")
+        results.append({
+            "RESOLVED_ENTITIES": item["RESOLVED_ENTITIES"],
+            "AUXILIARY_DESCRIPTIONS": item["AUXILIARY_DESCRIPTIONS"]
+        })
+    return results
+
+def read_ner_output(ner_path, wait=0):
+    """
+    Read a chunk's NER output. When NER runs as a separate process at the same
+    time (run_pipeline.py --pipeline-ner-coref), poll up to `wait` seconds for
+    the file to appear.
+    """
+    deadline = time.time() + wait
+    while True:
+        try:
+            with open(ner_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            if time.time() >= deadline:
+                raise
+            time.sleep(1)
+
+def load_chunk_inputs(fname, args, ner_futures=None):
+    """
+    Return (chunk_name, chunk_text, ner_entities, aux_current) for one chunk
+    file. The files are read on the discovery pass and kept in
+    args.chunk_cache, so verification passes do not read or parse them again.
+    """
+    cached = args.chunk_cache.get(fname)
+    if cached is not None:
+        return cached
+
+    # When NER is still running (pipelined from run_pipeline4), wait only
+    # for this chunk's NER output; errors from NER propagate here
+    if ner_futures is not None and fname in ner_futures:
+        ner_futures[fname].result()
+
+    chunk_name = fname.replace(".txt", "")
+    chunk_path = os.path.join(args.chunks_dir, fname)
+    ner_path = os.path.join(args.ner_dir, chunk_name + ".json")
+
+    with open(chunk_path, 'r', encoding='utf-8') as f:
+        chunk_text = f.read()
+    ner_data = read_ner_output(ner_path, args.wait_for_ner)
+
+    ner_entities = ner_data.get("ENTITIES", {})
+    aux_current = ner_data.get("PROPER_NOUN_DESCRIPTION", {})
+    args.chunk_cache[fname] = (chunk_name, chunk_text, ner_entities, aux_current)
+    return args.chunk_cache[fname]
+
+def relevant_memory(resolved_entities, aux_descriptions, batch_items):
+    """
+    Return the part of the memory that concerns the given chunks: the resolved
+    mentions that occur in a chunk's text or NER output, and the descriptions
+    of those mentions and of the entities they resolve to. Only the prompt is
+    pruned; replies are still merged into the full memory.
+    """
+    texts_lower = [chunk_text.lower() for _, chunk_text, _, _ in batch_items]
+    ner_names = set()
+    for _, _, ner_entities, aux_current in batch_items:
+        for names in ner_entities.values():
+            if isinstance(names, list):
+                ner_names.update(name for name in names if isinstance(name, str))
+        ner_names.update(aux_current)
+
+    def mentioned(name):
+        if name in ner_names:
+            return True
+        name_lower = name.lower()
+        return any(name_lower in text for text in texts_lower)
+
+    resolved = {k: v for k, v in resolved_entities.items() if mentioned(k)}
+    keep = set(resolved) | {v for v in resolved.values() if isinstance(v, str)}
+    aux = {k: v for k, v in aux_descriptions.items() if k in keep or mentioned(k)}
+    return resolved, aux
+
+def cached_result(full_prompt, args, label, parse):
+    """With --use-cache, return the parsed cached reply for this exact prompt, or None."""
+    if not args.use_cache:
+        return None
+    result_raw = llm_cache.get(args.model, full_prompt)
+    if result_raw is None:
+        return None
+    try:
+        result = parse(result_raw)
+    except Exception:
+        return None
+    log(f"Cache hit for {label}; skipping Ollama.", args.log_file)
+    return result
+
+def infer_with_retries(full_prompt, args, label, parse=extract_json_from_ollama, fmt=None, options=None):
+    """
+    Call Ollama and return parse(reply), making up to --max-retries attempts.
+
+    Server-side failures back off exponentially with jitter before the next
+    attempt, and after a timeout the remaining attempts get the extended
+    timeout. Unusable replies are retried right away; fatal (4xx) errors are
+    not retried.
+    """
+    cached = cached_result(full_prompt, args, label, parse)
+    if cached is not None:
+        return cached
+
+    max_retries = max(1, args.max_retries if hasattr(args, "max_retries") else 3)
+    timeout = 120
+    last_error = None
+
+    for attempt in range(max_retries):
+        try:
+            log(f"Prompt length (chars): {len(full_prompt)}", args.log_file)
+            start_time = time.time()
+            url = args.backends.acquire()
+            timed_out = False
+            try:
+                result_raw = run_ollama_inference(full_prompt, args.model, url, timeout=timeout, stream=args.stream,
+                                                  keep_alive=args.keep_alive, fmt=fmt, options=options)
+            except InferenceTimeout:
+                timed_out = True
+                raise
+            finally:
+                args.backends.release(url, timed_out)
+            elapsed = round(time.time() - start_time, 2)
+
+            log(f"[Attempt {attempt + 1}] Response received in {elapsed} seconds for {label}", args.log_file)
+
+            result = parse(result_raw)
+            if args.use_cache:
+                llm_cache.put(args.model, full_prompt, result_raw)
+            return result
+
+        except FatalError as e:
+            log(f"[Attempt {attempt + 1}] Failed to process {label}, not retrying: {e}", args.log_file)
+            raise
 
-        ner_entities = ner_data.get("ENTITIES", {})
-        aux_current = ner_data.get("PROPER_NOUN_DESCRIPTION", {})
+        except RetryableError as e:
+            last_error = e
+            log(f"[Attempt {attempt + 1}] Failed to process {label}: {e}", args.log_file)
 
+            if isinstance(e, InferenceTimeout) and timeout < 300:
+                log("Timeout detected. Retrying with increased timeout (300 seconds).", args.log_file)
+                timeout = 300
+
+            if attempt + 1 < max_retries:
+                delay = min(MAX_BACKOFF, 2 ** attempt) + random.random()
+                log(f"Backing off {delay:.1f} seconds before retrying {label}.", args.log_file)
+                time.sleep(delay)
+
+        except Exception as e:
+            last_error = e
+            log(f"[Attempt {attempt + 1}] Failed to process {label}: {e}", args.log_file)
+
+    log(f"Maximum retries reached for {label}. Skipping.", args.log_file)
+    raise Exception(f"Ollama inference failed for {label} after {max_retries} attempts. Last error: {last_error}")
+
+async def run_ollama_inference_async(session, prompt, model, url, timeout=120, keep_alive=None, fmt=None, options=None):
+    try:
+        async with session.post(
+            url,
+            data=request_body(prompt, model, False, keep_alive, fmt, options),
+            headers=_SESSION_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            if response.status >= 400:
+                message = f"HTTP error occurred: {response.status} {response.reason} - {await response.text()}"
+                if response.status < 500 and response.status != 429:
+                    raise FatalError(message)
+                raise RetryableError(message)
+            body = await response.json(content_type=None)
+            return body['response']
+
+    except asyncio.TimeoutError:
+        raise InferenceTimeout("Ollama inference timed out.")
+
+    except aiohttp.ClientError as req_err:
+        raise RetryableError(f"Request failed: {req_err}")
+
+async def infer_with_retries_async(session, full_prompt, args, label, parse=extract_json_from_ollama, fmt=None, options=None):
+    """Same retry, backoff and routing policy as infer_with_retries, on the event loop."""
+    cached = cached_result(full_prompt, args, label, parse)
+    if cached is not None:
+        return cached
+
+    max_retries = max(1, args.max_retries)
+    timeout = 120
+    last_error = None
+
+    for attempt in range(max_retries):
+        try:
+            log(f"Prompt length (chars): {len(full_prompt)}", args.log_file)
+            start_time = time.time()
+            url = args.backends.acquire()
+            timed_out = False
+            try:
+                result_raw = await run_ollama_inference_async(session, full_prompt, args.model, url, timeout=timeout,
+                                                              keep_alive=args.keep_alive, fmt=fmt, options=options)
+            except InferenceTimeout:
+                timed_out = True
+                raise
+            finally:
+                args.backends.release(url, timed_out)
+            elapsed = round(time.time() - start_time, 2)
+
+            log(f"[Attempt {attempt + 1}] Response received in {elapsed} seconds for {label}", args.log_file)
+
+            result = parse(result_raw)
+            if args.use_cache:
+                llm_cache.put(args.model, full_prompt, result_raw)
+            return result
+
+        except FatalError as e:
+            log(f"[Attempt {attempt + 1}] Failed to process {label}, not retrying: {e}", args.log_file)
+            raise
+
+        except RetryableError as e:
+            last_error = e
+            log(f"[Attempt {attempt + 1}] Failed to process {label}: {e}", args.log_file)
+
+            if isinstance(e, InferenceTimeout) and timeout < 300:
+                log("Timeout detected. Retrying with increased timeout (300 seconds).", args.log_file)
+                timeout = 300
+
+            if attempt + 1 < max_retries:
+                delay = min(MAX_BACKOFF, 2 ** attempt) + random.random()
+                log(f"Backing off {delay:.1f} seconds before retrying {label}.", args.log_file)
+                await asyncio.sleep(delay)
+
+        except Exception as e:
+            last_error = e
+            log(f"[Attempt {attempt + 1}] Failed to process {label}: {e}", args.log_file)
+
+    log(f"Maximum retries reached for {label}. Skipping.", args.log_file)
+    raise Exception(f"Ollama inference failed for {label} after {max_retries} attempts. Last error: {last_error}")
+
+def output_path(chunk_name, args, verification=False):
+    return os.path.join(args.output_dir, chunk_name + ("_verify" if verification else "") + ".json")
+
+def write_json_atomic(path, obj):
+    # Write to a temp file and rename, so a crash never leaves a truncated
+    # file behind for --resume to trust
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+def save_results(chunk_names, results, args, verification=False):
+    for chunk_name, result in zip(chunk_names, results):
+        out_path = output_path(chunk_name, args, verification)
+        write_json_atomic(out_path, result)
+
+        log(f"Saved coref output: {out_path}", args.log_file)
+
+def load_saved_results(fnames, args, verification=False):
+    """
+    With --resume, return the saved results for fnames when every one of them
+    exists and is valid, else None. Only the discovery pass is resumed: the
+    verification passes all write to the same _verify files, so a saved file
+    cannot tell which pass produced it.
+    """
+    if not args.resume or verification:
+        return None
+
+    results = []
+    for fname in fnames:
+        try:
+            with open(output_path(fname.replace(".txt", ""), args), 'r', encoding='utf-8') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(result, dict) or "RESOLVED_ENTITIES" not in result or "AUXILIARY_DESCRIPTIONS" not in result:
+            return None
+        results.append(result)
+    return results
+
+def prepare_request(fnames, args, prompt_template, resolved_entities, aux_descriptions, verification=False, ner_futures=None):
+    """
+    Build the prompt for one Ollama call covering fnames.
+    Returns (full_prompt, label, chunk_names, parse), where parse turns the
+    reply into one result per chunk.
+    """
+    batch_items = [load_chunk_inputs(fname, args, ner_futures) for fname in fnames]
+    chunk_names = [item[0] for item in batch_items]
+
+    if args.prune_memory:
+        resolved_entities, aux_descriptions = relevant_memory(resolved_entities, aux_descriptions, batch_items)
+
+    if len(batch_items) == 1:
+        chunk_name, chunk_text, ner_entities, aux_current = batch_items[0]
         full_prompt = inject_prompt(
             prompt_template,
             resolved_entities,
@@ -104,110 +713,125 @@ def process_chunks(chunk_files, args, prompt_template, resolved_entities, aux_de
             ner_entities,
             aux_current,
             chunk_text,
-            verification=verification
+            verification=verification,
+            compact=args.compact_json
         )
         log(f"Processing {chunk_name} (verification={verification})...", args.log_file)
-        
-        '''
-        try:
-            result_raw = run_ollama_inference(full_prompt, args.model, args.ollama_url)
-            result = extract_json_from_ollama(result_raw)
-        except Exception as e:
-            log(f"Failed to process {chunk_name}: {e}", args.log_file)
-            raise
-        '''
-       
-        '''
-        max_retries = max(1, args.max_retries if hasattr(args, "max_retries") else 3)
-        attempt = 0
-        success = False
-        while attempt < max_retries and not success:
-            try:
-                #result_raw = run_ollama_inference(full_prompt, args.model, args.ollama_url)
-                log(f"Prompt length (chars): {len(full_prompt)}", args.log_file)
-                result_raw = run_ollama_inference(full_prompt, args.model, args.ollama_url, timeout=120)            
-                try:
-                    result = extract_json_from_ollama(result_raw)
-                    success = True
-                except Exception as json_error:
-                    log(f"[Attempt {attempt+1}] JSON parsing failed for {chunk_name}. Raw model output:\n{result_raw}", args.log_file)
-                    raise json_error  # Let it go to outer except to handle retries
-            except Exception as e:
-                attempt += 1
-                log(f"[Attempt {attempt}] Failed to process {chunk_name}: {e}", args.log_file)
-                if attempt == max_retries:
-                    log(f"Maximum retries reached for {chunk_name}. Skipping.", args.log_file)
-                    raise
-        '''
-
-        max_retries = max(1, args.max_retries if hasattr(args, "max_retries") else 3)
-        timeout_retry_done = False
-        attempt = 0
-        success = False
-        last_error = None
-
-        while attempt < max_retries and not success:
-            try:
-                log(f"Prompt length (chars): {len(full_prompt)}", args.log_file)
-                start_time = time.time()
-                result_raw = run_ollama_inference(full_prompt, args.model, args.ollama_url, timeout=120)
-                elapsed = round(time.time() - start_time, 2)
-
-                log(f"[Attempt {attempt + 1}] Response received in {elapsed} seconds for {chunk_name}", args.log_file)
-
-                result = extract_json_from_ollama(result_raw)
-                success = True
-
-            except Exception as e:
-                error_message = str(e).lower()
-                last_error = e
-                log(f"[Attempt {attempt + 1}] Failed to process {chunk_name}: {e}", args.log_file)
-                attempt += 1
-
-                # Retry once with extended timeout if it's a timeout error
-                if "timed out" in error_message and not timeout_retry_done:
-                    log("Timeout detected. Retrying once with increased timeout (300 seconds).", args.log_file)
-                    timeout_retry_done = True
-                    try:
-                        retry_start = time.time()
-                        result_raw = run_ollama_inference(full_prompt, args.model, args.ollama_url, timeout=300)
-                        retry_elapsed = round(time.time() - retry_start, 2)
-
-                        log(f"[Extended Timeout] Response received in {retry_elapsed} seconds for {chunk_name}", args.log_file)
-
-                        result = extract_json_from_ollama(result_raw)
-                        success = True
-                        continue  # Skip the rest and start the next iteration (which won't happen because success=True)
-                    except Exception as retry_e:
-                        retry_elapsed = round(time.time() - retry_start, 2)
-                        last_error = retry_e
-                        log(f"[Extended Timeout] Failed after {retry_elapsed} seconds for {chunk_name}: {retry_e}", args.log_file)
-                        log(f"Retry after timeout also failed: {retry_e}", args.log_file)
-                        if not success:
-                            attempt += 1
-
-        if not success:
-            log(f"Maximum retries reached for {chunk_name}. Skipping.", args.log_file)
-            raise Exception(f"Ollama inference failed for {chunk_name} after {attempt} attempts. Last error: {last_error}")
-
-        resolved_entities.update(result.get("RESOLVED_ENTITIES", {}))
-        aux_descriptions.update(result.get("AUXILIARY_DESCRIPTIONS", {}))
-
-        out_path = os.path.join(args.output_dir, chunk_name + ("_verify" if verification else "") + ".json")
-        with open(out_path, 'w', encoding='utf-8') as out_file:
-            json.dump(result, out_file, indent=2)
-
-        log(f"Saved coref output: {out_path}", args.log_file)
-
-    final_memory_path = os.path.join(args.base_output_folder, "final_memory.json")
-    with open(final_memory_path, 'w', encoding='utf-8') as f:
-        json.dump({
-            "RESOLVED_ENTITIES": resolved_entities,
-            "AUXILIARY_DESCRIPTIONS": aux_descriptions
-        }, f, indent=2)
-    log(f"Final memory saved to: {final_memory_path}", args.log_file)
-
-def main():
+        return full_prompt, chunk_name, chunk_names, lambda raw: [extract_json_from_ollama(raw)]
+
+    label = f"{chunk_names[0]}..{chunk_names[-1]}"
+    full_prompt = inject_batch_prompt(prompt_template, resolved_entities, aux_descriptions, batch_items,
+                                      compact=args.compact_json)
+    log(f"Processing {label} as one batch of {len(chunk_names)} (verification={verification})...", args.log_file)
+    return full_prompt, label, chunk_names, lambda raw: extract_batch_json_from_ollama(raw, chunk_names)
+
+def process_batch(fnames, args, prompt_template, resolved_entities, aux_descriptions, verification=False, ner_futures=None):
+    """
+    Run coref for one or more chunks in one Ollama call and save each chunk's
+    output. Returns the parsed results in the order of fnames; the caller
+    merges them into the shared memory.
+    """
+    saved = load_saved_results(fnames, args, verification)
+    if saved is not None:
+        log(f"Resuming: reusing saved coref output for {', '.join(fnames)}", args.log_file)
+        return saved
+
+    full_prompt, label, chunk_names, parse = prepare_request(
+        fnames, args, prompt_template, resolved_entities, aux_descriptions,
+        verification=verification, ner_futures=ner_futures
+    )
+    results = infer_with_retries(full_prompt, args, label, parse=parse, fmt=response_format(args, len(fnames) > 1),
+                                 options=context_options(full_prompt, args, label, len(fnames)))
+    save_results(chunk_names, results, args, verification)
+    return results
+
+async def process_batch_async(session, fnames, args, prompt_template, resolved_entities, aux_descriptions, verification=False, ner_futures=None):
+    saved = load_saved_results(fnames, args, verification)
+    if saved is not None:
+        log(f"Resuming: reusing saved coref output for {', '.join(fnames)}", args.log_file)
+        return saved
+
+    # File reads and waits on pipelined NER run off the event loop
+    full_prompt, label, chunk_names, parse = await asyncio.to_thread(
+        prepare_request, fnames, args, prompt_template, resolved_entities, aux_descriptions,
+        verification=verification, ner_futures=ner_futures
+    )
+    results = await infer_with_retries_async(session, full_prompt, args, label, parse=parse,
+                                             fmt=response_format(args, len(fnames) > 1),
+                                             options=context_options(full_prompt, args, label, len(fnames)))
+    save_results(chunk_names, results, args, verification)
+    return results
+
+def changed_entries(update, current):
+    return {k: v for k, v in update.items() if k not in current or current[k] != v}
+
+def merge_results(fnames, results, args, resolved_entities, aux_descriptions, pass_label):
+    """Merge one batch's results into the memory and log each chunk's changes."""
+    for fname, result in zip(fnames, results):
+        new_resolved = changed_entries(result.get("RESOLVED_ENTITIES", {}), resolved_entities)
+        new_aux = changed_entries(result.get("AUXILIARY_DESCRIPTIONS", {}), aux_descriptions)
+        resolved_entities.update(new_resolved)
+        aux_descriptions.update(new_aux)
+        args.memory_log.append(pass_label, fname.replace(".txt", ""), new_resolved, new_aux)
+
+def process_windows(batches, args, prompt_template, resolved_entities, aux_descriptions, verification=False, ner_futures=None, pass_label="discovery"):
+    concurrency = max(1, args.concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for start in range(0, len(batches), concurrency):
+            window = batches[start:start + concurrency]
+            resolved_snapshot = dict(resolved_entities)
+            aux_snapshot = dict(aux_descriptions)
+            futures = [
+                pool.submit(process_batch, fnames, args, prompt_template, resolved_snapshot, aux_snapshot,
+                            verification=verification, ner_futures=ner_futures)
+                for fnames in window
+            ]
+            for fnames, future in zip(window, futures):
+                merge_results(fnames, future.result(), args, resolved_entities, aux_descriptions, pass_label)
+
+async def process_windows_async(batches, args, prompt_template, resolved_entities, aux_descriptions, verification=False, ner_futures=None, pass_label="discovery"):
+    concurrency = max(1, args.concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for start in range(0, len(batches), concurrency):
+            window = batches[start:start + concurrency]
+            resolved_snapshot = dict(resolved_entities)
+            aux_snapshot = dict(aux_descriptions)
+            window_results = await asyncio.gather(*(
+                process_batch_async(session, fnames, args, prompt_template, resolved_snapshot, aux_snapshot,
+                                    verification=verification, ner_futures=ner_futures)
+                for fnames in window
+            ))
+            for fnames, results in zip(window, window_results):
+                merge_results(fnames, results, args, resolved_entities, aux_descriptions, pass_label)
+
+def process_chunks(chunk_files, args, prompt_template, resolved_entities, aux_descriptions, verification=False, ner_futures=None, pass_label="discovery"):
+    chunk_files = [fname for fname in chunk_files if fname.endswith(".txt")]
+
+    # With --resume, chunks this pass already merged (replayed from memory.jsonl) are skipped
+    done = [fname for fname in chunk_files if args.memory_log.done(pass_label, fname.replace(".txt", ""))]
+    if done:
+        log(f"Resuming: {len(done)} chunk(s) of the {pass_label} pass already in memory.jsonl", args.log_file)
+        chunk_files = [fname for fname in chunk_files if fname not in done]
+
+    # --chunks-per-call K packs K consecutive chunks into one prompt; the
+    # memory is then updated once per batch instead of once per chunk
+    per_call = max(1, args.chunks_per_call)
+    batches = [chunk_files[i:i + per_call] for i in range(0, len(chunk_files), per_call)]
+
+    # Each prompt carries the memory built from the chunks before it.
+    # With --concurrency N, batches are sent in windows of N against a snapshot
+    # of the memory taken when the window starts, and the results are merged
+    # back in chunk order, so the output does not depend on completion order.
+    # N=1 (the default) is the fully sequential behavior.
+    if args.aiohttp:
+        asyncio.run(process_windows_async(batches, args, prompt_template, resolved_entities, aux_descriptions,
+                                          verification=verification, ner_futures=ner_futures, pass_label=pass_label))
+    else:
+        process_windows(batches, args, prompt_template, resolved_entities, aux_descriptions,
+                        verification=verification, ner_futures=ner_futures, pass_label=pass_label)
+
+def main(argv=None, ner_futures=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--chunks-dir", required=True)
     parser.add_argument("--ner-dir", required=True)
@@ -219,27 +843,86 @@ def main():
     parser.add_argument("--verify-passes", type=int, default=0)
     parser.add_argument("--log-file", required=True)
     parser.add_argument("--max-retries", type=int, default=3, help="Maximum number of retries for failed coref requests")
-    args = parser.parse_args()
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Chunks sent to Ollama at once; each window of chunks shares one memory snapshot")
+    parser.add_argument("--chunks-per-call", type=int, default=1,
+                        help="Chunks packed into a single prompt (the model returns a CHUNKS list)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream replies and stop reading once the JSON object is complete")
+    parser.add_argument("--ollama-urls",
+                        help="Comma-separated Ollama hosts (host:port) to spread requests over; "
+                             "defaults to OLLAMA_HOST")
+    parser.add_argument("--prune-memory", action="store_true",
+                        help="Send only the memory entries that concern the chunk(s) in each prompt")
+    parser.add_argument("--wait-for-ner", type=int, default=0,
+                        help="Seconds to wait for each chunk's NER output to appear (NER running alongside)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Replay memory.jsonl and reuse saved discovery-pass outputs instead of calling Ollama again")
+    parser.add_argument("--use-cache", action="store_true", help="Reuse cached Ollama responses for identical prompts")
+    parser.add_argument("--compact-json", action="store_true",
+                        help="Embed the memory and chunk data in the prompt as compact JSON instead of indented")
+    parser.add_argument("--keep-alive", default="24h",
+                        help="How long Ollama keeps the model loaded between requests (default 24h)")
+    parser.add_argument("--format", choices=["json", "schema"],
+                        help="Constrain replies with Ollama structured outputs: any valid JSON, "
+                             "or JSON matching the coref schema (Ollama 0.5+)")
+    parser.add_argument("--auto-num-ctx", action="store_true",
+                        help="Size num_ctx to each prompt (power of two) instead of the model's default context")
+    parser.add_argument("--num-predict", type=int, default=2048,
+                        help="Output tokens allowed per chunk with --auto-num-ctx")
+    parser.add_argument("--max-num-ctx", type=int, default=32768,
+                        help="Upper bound on num_ctx with --auto-num-ctx")
+    parser.add_argument("--aiohttp", action="store_true",
+                        help="Send the concurrent requests from one asyncio event loop (aiohttp) "
+                             "instead of worker threads")
+    args = parser.parse_args(argv)
+
+    if args.aiohttp and not AIOHTTP_AVAILABLE:
+        log("aiohttp is not installed; using worker threads instead. Run: pip install aiohttp", args.log_file)
+        args.aiohttp = False
+    if args.aiohttp and args.stream:
+        parser.error("--stream is only supported with worker threads, not with --aiohttp")
 
     # Set Ollama URL here
-    args.ollama_url = f"http://{os.environ.get('OLLAMA_HOST', '127.0.0.1:11434')}/api/generate"
+    hosts = args.ollama_urls.split(",") if args.ollama_urls else [os.environ.get('OLLAMA_HOST', '127.0.0.1:11434')]
+    args.backends = BackendPool(f"http://{host.strip()}/api/generate" for host in hosts if host.strip())
 
     output_path = os.path.join(args.base_output_folder, "coref_outputs")
     os.makedirs(output_path, exist_ok=True)
     args.output_dir = output_path
 
-    discovery_prompt = load_prompt_template(args.prompt_file)
-    verify_prompt = load_prompt_template(args.verify_prompt_file) if args.verify_prompt_file else discovery_prompt
+    # Stripped once here; inject_prompt uses the templates as they are
+    discovery_prompt = load_prompt_template(args.prompt_file).strip()
+    verify_prompt = load_prompt_template(args.verify_prompt_file).strip() if args.verify_prompt_file else discovery_prompt
     chunk_files = sorted(os.listdir(args.chunks_dir))
+    args.chunk_cache = {}
 
     resolved_entities = {}
     aux_descriptions = {}
 
-    process_chunks(chunk_files, args, discovery_prompt, resolved_entities, aux_descriptions, verification=False)
+    args.memory_log = MemoryLog(os.path.join(args.base_output_folder, "memory.jsonl"), resume=args.resume)
+    replayed = args.memory_log.replay(resolved_entities, aux_descriptions)
+    if replayed:
+        log(f"Resuming: replayed {replayed} entries from memory.jsonl", args.log_file)
+
+    try:
+        process_chunks(chunk_files, args, discovery_prompt, resolved_entities, aux_descriptions, verification=False,
+                       ner_futures=ner_futures, pass_label="discovery")
+
+        for i in range(args.verify_passes):
+            log(f"Starting verification pass {i+1}...", args.log_file)
+            process_chunks(chunk_files, args, verify_prompt, resolved_entities, aux_descriptions, verification=True,
+                           pass_label=f"verify-{i+1}")
+    finally:
+        args.memory_log.close()
 
-    for i in range(args.verify_passes):
-        log(f"Starting verification pass {i+1}...", args.log_file)
-        process_chunks(chunk_files, args, verify_prompt, resolved_entities, aux_descriptions, verification=True)
+    final_memory_path = os.path.join(args.base_output_folder, "final_memory.json")
+    write_json_atomic(final_memory_path, {
+        "RESOLVED_ENTITIES": resolved_entities,
+        "AUXILIARY_DESCRIPTIONS": aux_descriptions
+    })
+    log(f"Final memory saved to: {final_memory_path}", args.log_file)
 
 if __name__ == "__main__":
     main()
+    close_session()
@@ -2,20 +2,88 @@ import os
 import argparse
 import json
 import requests
+import urllib3
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
 
+try:
+    # ijson picks its fastest installed backend (yajl2_c when available)
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
+try:
+    # Permissive parser for trailing commas, single quotes, unquoted keys, comments
+    import json5
+    JSON5_AVAILABLE = True
+except ImportError:
+    JSON5_AVAILABLE = False
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    # orjson is optional; fall back to the stdlib encoder/decoder
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    json_loads = json.loads
+
+import llm_cache
+from logutil import get_file_logger
+
 OLLAMA_URL_TEMPLATE = "http://{host}/api/generate"
 
+# Stray apostrophe before the colon of a key, e.g. "PROPER_NOUN': [...]
+KEY_APOS_RE = re.compile(r'"([^"\n\r]+?)\'\s*:')
+
+# Stricter instructions used on NER retries, inserted between the template and the chunk
+LOCATION_FALLBACK_PROMPT = (
+    "You are a LOCATION entity extraction API. Return ONLY a valid JSON object.\n"
+    "Do not explain, interpret, or comment — not even inside lists or descriptions.\n"
+    "All list values must be quoted strings (e.g., [\"X\", \"Y\"]).\n"
+    "Descriptions must be short and factual, based strictly on the input text.\n\n"
+    "Your output MUST strictly follow this format:\n\n"
+    "{\n"
+    "  \"ENTITIES\": {\n"
+    "    \"PROPER_NOUN\": [\"Location A\", \"Location B\"],\n"
+    "    \"NOUN_PHRASE\": [\"the checkpoint\", \"the road\"]\n"
+    "  },\n"
+    "  \"PROPER_NOUN_DESCRIPTION\": {\n"
+    "    \"Location A\": \"A location mentioned in the legal case\",\n"
+    "    \"Location B\": \"Another place referenced in the context\"\n"
+    "  }\n"
+    "}\n\n"
+    "IMPORTANT: If no entities are found, return an empty list or object.\n"
+    "Begin your JSON response below:\n\n"
+)
+
+# Pooled keep-alive connections to Ollama, shared by every inference call
+_SESSION = requests.Session()
+_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+_SESSION_HEADERS = {
+    "Connection": "keep-alive",
+    "Accept-Encoding": "gzip, deflate",
+    "Content-Type": "application/json",
+}
+
+
+def close_session():
+    _SESSION.close()
+
 
 def log(msg, log_file=None):
     time_stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     formatted = f"[{time_stamp}] {msg}"
     print(formatted)
     if log_file:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(formatted + '\n')
+        get_file_logger(log_file).info(formatted)
 
 '''
 def extract_json_from_ollama(raw_response):
@@ -45,43 +113,124 @@ def extract_json_from_ollama(raw_response):
         raise ValueError(f"Invalid JSON format. {e}")
 '''
 
-def extract_json_from_ollama(raw_response):
-    if not raw_response.strip().startswith("{"):
-        raise ValueError("Output does not start with '{'. Unexpected format:\n" + raw_response[:300])
+def largest_json_object(text):
+    """Return the longest balanced top-level {...} span of text, or None."""
+    best = None
+    start = None
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+
+        # Quotes only delimit strings inside an object; prose around it is ignored
+        if ch == '"' and depth > 0:
+            in_string = True
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth > 0:
+            depth -= 1
+            if depth == 0 and (best is None or i + 1 - start > best[1] - best[0]):
+                best = (start, i + 1)
+
+    return text[best[0]:best[1]] if best else None
+
+
+def complete_schema(result):
+    """
+    Fill missing or null NER keys with empty defaults, in place. A key that is
+    present with the wrong type raises ValueError, so the reply goes through
+    the format-failure retry instead of being saved as an empty result.
+    """
+    entities = result.get("ENTITIES")
+    if entities is None:
+        entities = result["ENTITIES"] = {}
+    elif not isinstance(entities, dict):
+        raise ValueError(f"ENTITIES should be an object, got {type(entities).__name__}.")
+
+    for key in ["PROPER_NOUN", "NOUN_PHRASE"]:
+        if entities.get(key) is None:
+            entities[key] = []
+        elif not isinstance(entities[key], list):
+            raise ValueError(f"ENTITIES.{key} should be a list, got {type(entities[key]).__name__}.")
+
+    descriptions = result.get("PROPER_NOUN_DESCRIPTION")
+    if descriptions is None:
+        result["PROPER_NOUN_DESCRIPTION"] = {}
+    elif not isinstance(descriptions, dict):
+        raise ValueError(f"PROPER_NOUN_DESCRIPTION should be an object, got {type(descriptions).__name__}.")
+    return result
 
+
+def extract_json_from_ollama(raw_response):
+    """
+    Parse the NER JSON out of a model reply, repairing it where that is
+    deterministic, and complete the schema. Raises ValueError only when no
+    usable object can be recovered, which is when a new inference is needed.
+    """
+    result = None
     try:
         result = json.loads(raw_response)
-
-        if not result:
-            raise ValueError("Parsed JSON is empty.")
-
-        if "ENTITIES" in result:
-            for key in ["PROPER_NOUN", "NOUN_PHRASE"]:
-                if key in result["ENTITIES"] and result["ENTITIES"][key] is None:
-                    result["ENTITIES"][key] = []
-
-        if "PROPER_NOUN_DESCRIPTION" in result and result["PROPER_NOUN_DESCRIPTION"] is None:
-            result["PROPER_NOUN_DESCRIPTION"] = {}
-
-        return result
-
     except json.JSONDecodeError as e:
         # Debug preview
         print("\n===== RAW LLM OUTPUT (for debug) =====\n")
         print(raw_response[:1000])
         print("\n======================================\n")
 
-        # Attempt to fix stray apostrophes before colon in keys
-        repaired = re.sub(r'"([^"\n\r]+?)\'\s*:', r'"\1":', raw_response)
-
-        try:
-            result = json.loads(repaired)
-            print("Fixed JSON format by removing stray apostrophes in keys.")
-            return result
-        except json.JSONDecodeError:
+        # Repairs are tried in order, each one saving a full re-inference:
+        #   1. json5 (trailing commas, single quotes, unquoted keys, comments)
+        #   2. the first '{' to the last '}' (drops commentary around the JSON)
+        #   3. the largest balanced {...} block (commentary containing braces)
+        #   4. stray apostrophes before the colon in keys
+        candidates = []
+        if JSON5_AVAILABLE:
+            candidates.append(("json5", json5.loads, raw_response))
+
+        first, last = raw_response.find("{"), raw_response.rfind("}")
+        if first != -1 and last > first:
+            outer = raw_response[first:last + 1]
+            if outer != raw_response.strip():
+                candidates.append(("extracting the outer {...} span", json.loads, outer))
+                if JSON5_AVAILABLE:
+                    candidates.append(("json5 on the outer {...} span", json5.loads, outer))
+
+        block = largest_json_object(raw_response)
+        if block is not None and block != raw_response.strip():
+            candidates.append(("extracting the largest {...} block", json.loads, block))
+
+        candidates.append(("removing stray apostrophes in keys", json.loads,
+                           KEY_APOS_RE.sub(r'"\1":', raw_response)))
+
+        for how, loads, text in candidates:
+            try:
+                result = loads(text)
+            except ValueError:
+                continue
+            print(f"Fixed JSON format with {how}.")
+            break
+        else:
             raise ValueError(f"Invalid JSON format. {e}")
 
+    if not isinstance(result, dict):
+        raise ValueError(f"Expected a JSON object, got {type(result).__name__}.")
+    if not result:
+        raise ValueError("Parsed JSON is empty.")
+
+    return complete_schema(result)
+
 
+# Templates are read once per process, even when pipeline stages run in-process
+@lru_cache(maxsize=16)
 def load_prompt_template(path):
     with open(path, 'r', encoding='utf-8') as f:
         return f.read()
@@ -98,36 +247,168 @@ def run_ollama_inference(prompt, model_name, ollama_url):
     return response.json().get('response', '')
 '''
 
-def run_ollama_inference(prompt, model_name, ollama_url, timeout=120):
+def read_response_field(response):
+    """
+    Return the "response" field of an Ollama reply (None if absent).
+
+    With ijson the body is parsed as a stream, so the large "context" token
+    array that follows is never materialized as Python objects.
+    """
+    if not IJSON_AVAILABLE:
+        return json_loads(response.content).get('response')
+
+    response.raw.decode_content = True
     try:
-        response = requests.post(
+        for prefix, event, value in ijson.parse(response.raw):
+            if prefix == 'response' and event == 'string':
+                return value
+        return None
+    except ijson.JSONError as e:
+        raise ValueError(str(e))
+    except urllib3.exceptions.HTTPError as e:
+        # Reading response.raw bypasses requests' own error mapping; map a
+        # stalled or broken body to the requests exceptions the caller handles
+        response.close()
+        if isinstance(e, urllib3.exceptions.ReadTimeoutError):
+            raise requests.exceptions.ReadTimeout(e)
+        raise requests.exceptions.ConnectionError(e)
+    finally:
+        # Discard the rest of the body so the connection can go back to the pool
+        response.raw.drain_conn()
+        response.raw.release_conn()
+
+
+class OllamaRequestError(Exception):
+    """The request to Ollama failed (timeout, HTTP error, malformed envelope)."""
+
+
+def run_ollama_inference(prompt, model_name, ollama_url, timeout=120, use_cache=False):
+    """Return (reply, from_cache); from_cache is True when the reply came from llm_cache."""
+    if use_cache:
+        cached = llm_cache.get(model_name, prompt)
+        if cached is not None:
+            return cached, True
+
+    try:
+        response = _SESSION.post(
             ollama_url,
-            json={
+            data=json_dumps({
                 "model": model_name,
                 "prompt": prompt,
                 "stream": False
-            },
+            }),
+            headers=_SESSION_HEADERS,
+            stream=True,
             timeout=timeout
         )
         response.raise_for_status()  # Raises HTTPError for bad responses
 
         # Return the response, or fallback to empty string if missing
-        return response.json().get('response', '')
+        result = read_response_field(response)
+        if result is None:
+            result = ''
 
     except requests.exceptions.Timeout:
-        raise Exception("Ollama inference timed out.")
+        raise OllamaRequestError("Ollama inference timed out.")
 
     except requests.exceptions.HTTPError as http_err:
-        raise Exception(f"HTTP error occurred: {http_err} - {response.text}")
+        raise OllamaRequestError(f"HTTP error occurred: {http_err} - {response.text}")
 
     except requests.exceptions.RequestException as req_err:
-        raise Exception(f"Request failed: {req_err}")
+        raise OllamaRequestError(f"Request failed: {req_err}")
 
     except ValueError:
-        raise Exception("Invalid JSON response received from Ollama.")
-
-
-def main():
+        raise OllamaRequestError("Invalid JSON response received from Ollama.")
+
+    return result, False
+
+
+def process_chunk(fname, args, template, ollama_url):
+    chunk_path = os.path.join(args.chunks_dir, fname)
+    chunk_text = Path(chunk_path).read_bytes().decode('utf-8').strip()
+
+    # Each prompt is assembled in a single join, and the retry prompt (the same
+    # for every retry) only once, the first time it is needed
+    base_prompt = "\n\n".join((template, chunk_text))
+    fallback_prompt = None
+    
+    #print("Base Prompt: ", base_prompt)
+    retry_count = 0
+    success = False
+
+    # Only a reply whose JSON could not be recovered switches to the stricter
+    # prompt; a request failure is retried with the prompt that was sent
+    format_failed = False
+
+    while retry_count <= args.max_retries:
+        full_prompt = base_prompt
+        if format_failed:
+            # The shared template stays the exact prompt prefix so Ollama can reuse
+            # its cached KV state; the fallback instructions go before the chunk
+            if fallback_prompt is None:
+                fallback_prompt = "".join((template, "\n\n", LOCATION_FALLBACK_PROMPT, chunk_text))
+            full_prompt = fallback_prompt
+
+        log(f"Running NER on {fname} (attempt {retry_count + 1})...", log_file=args.log_file)
+        
+        '''
+        try:
+            result_raw = run_ollama_inference(full_prompt, args.model_name, ollama_url)
+            result = extract_json_from_ollama(result_raw)
+            success = True
+            break
+        except Exception as e:
+            log(f"Format issue on attempt {retry_count + 1}: {e}", log_file=args.log_file)
+            retry_count += 1
+        '''
+        try:
+            log(f"Prompt length (chars): {len(full_prompt)}", log_file=args.log_file)
+            #result_raw = run_ollama_inference(full_prompt, args.model_name, ollama_url)
+            result_raw, from_cache = run_ollama_inference(full_prompt, args.model_name, ollama_url, timeout=120, use_cache=args.use_cache)
+            result = extract_json_from_ollama(result_raw)
+            # Only fresh replies that parse are cached; a cached bad reply would be
+            # replayed on every retry and every re-run instead of calling the model,
+            # and re-putting a hit would reset its TTL
+            if args.use_cache and not from_cache:
+                llm_cache.put(args.model_name, full_prompt, result_raw)
+            success = True
+            break
+        except OllamaRequestError as e:
+            log(f"Request failed on attempt {retry_count + 1}: {e}", log_file=args.log_file)
+            retry_count += 1
+            if retry_count > args.max_retries:
+                raise RuntimeError(f"Failed after {args.max_retries} attempts for chunk {fname}: {e}")
+        except Exception as e:
+            log(f"Format issue on attempt {retry_count + 1}: {e}", log_file=args.log_file)
+            format_failed = True
+
+             # Show preview if available
+            preview = locals().get("result_raw", "")
+            if preview:
+                preview_clean = preview[:300].replace("\n", " ").replace("\r", " ")
+                log(f"[Invalid JSON Preview on attempt {retry_count + 1}] {preview_clean}", log_file=args.log_file)
+            retry_count += 1
+            # Raise if final attempt fails
+            if retry_count > args.max_retries:
+                raise RuntimeError(f"Failed after {args.max_retries} attempts for chunk {fname}: {e}")
+
+    raw_out_path = os.path.join(args.output_dir, fname.replace(".txt", "_raw.txt"))
+    with open(raw_out_path, 'w', encoding='utf-8') as raw_file:
+        raw_file.write(result_raw)
+
+    # Written under a temp name and renamed, so a coref stage that polls for
+    # this file (run_pipeline.py --pipeline-ner-coref) never reads it half-written
+    out_path = os.path.join(args.output_dir, fname.replace(".txt", ".json"))
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out_file:
+        json.dump(result, out_file, indent=2)
+    os.replace(tmp_path, out_path)
+
+    log(f"Saved: {out_path}", log_file=args.log_file)
+
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--chunks-dir", required=True, help="Directory of chunk text files")
     parser.add_argument("--prompt-file", required=True, help="NER prompt file")
@@ -135,95 +416,59 @@ def main():
     parser.add_argument("--log-file", required=True, help="Path to shared log.txt file")
     parser.add_argument("--model-name", required=True, help="LLM model name")
     parser.add_argument("--max-retries", type=int, default=2, help="Number of retries for invalid JSON output")
-    args = parser.parse_args()
+    parser.add_argument("--use-cache", action="store_true", help="Reuse cached Ollama responses for identical prompts")
+    parser.add_argument("--schedule", choices=["fifo", "lpt"], default="fifo",
+                        help="Submission order: file order, or largest chunks first (lpt)")
+    return parser.parse_args(argv)
+
 
+def schedule_chunks(chunks_dir, chunk_files, schedule):
+    """
+    Order chunk files for submission. "fifo" keeps file order; "lpt" sends the
+    largest chunks first, so the slowest requests do not start last and leave
+    the other workers idle at the end of the run.
+    """
+    if schedule == "lpt":
+        return sorted(chunk_files, key=lambda f: os.path.getsize(os.path.join(chunks_dir, f)), reverse=True)
+    return chunk_files
+
+
+def submit_chunks(pool, args):
+    """Queue NER for every chunk on pool; returns {chunk file name: future}."""
     host = os.environ.get("OLLAMA_HOST", "127.0.0.1:11434")
     ollama_url = OLLAMA_URL_TEMPLATE.format(host=host)
 
     os.makedirs(args.output_dir, exist_ok=True)
     prompt_template = load_prompt_template(args.prompt_file)
+    template = prompt_template.strip()
 
-    chunk_files = sorted([f for f in os.listdir(args.chunks_dir) if f.endswith(".txt")])
+    chunk_files = sorted(e.name for e in os.scandir(args.chunks_dir) if e.name.endswith(".txt") and e.is_file())
     log(f"Found {len(chunk_files)} chunk files.", log_file=args.log_file)
 
-    for fname in tqdm(chunk_files, desc="Processing chunks"):
-        chunk_path = os.path.join(args.chunks_dir, fname)
-        with open(chunk_path, 'r', encoding='utf-8') as f:
-            chunk_text = f.read()
+    return {
+        fname: pool.submit(process_chunk, fname, args, template, ollama_url)
+        for fname in schedule_chunks(args.chunks_dir, chunk_files, args.schedule)
+    }
 
-        base_prompt = f"{prompt_template.strip()}\n\n{chunk_text.strip()}"
-        
-        #print("Base Prompt: ", base_prompt)
-        retry_count = 0
-        success = False
-
-        while retry_count <= args.max_retries:
-            full_prompt = base_prompt
-            if retry_count > 0:
-                full_prompt = (
-    "You are a LOCATION entity extraction API. Return ONLY a valid JSON object.\n"
-    "Do not explain, interpret, or comment — not even inside lists or descriptions.\n"
-    "All list values must be quoted strings (e.g., [\"X\", \"Y\"]).\n"
-    "Descriptions must be short and factual, based strictly on the input text.\n\n"
-    "Your output MUST strictly follow this format:\n\n"
-    "{\n"
-    "  \"ENTITIES\": {\n"
-    "    \"PROPER_NOUN\": [\"Location A\", \"Location B\"],\n"
-    "    \"NOUN_PHRASE\": [\"the checkpoint\", \"the road\"]\n"
-    "  },\n"
-    "  \"PROPER_NOUN_DESCRIPTION\": {\n"
-    "    \"Location A\": \"A location mentioned in the legal case\",\n"
-    "    \"Location B\": \"Another place referenced in the context\"\n"
-    "  }\n"
-    "}\n\n"
-    "IMPORTANT: If no entities are found, return an empty list or object.\n"
-    "Begin your JSON response below:\n\n"
-    + base_prompt
-)
 
-            log(f"Running NER on {fname} (attempt {retry_count + 1})...", log_file=args.log_file)
-            
-            '''
-            try:
-                result_raw = run_ollama_inference(full_prompt, args.model_name, ollama_url)
-                result = extract_json_from_ollama(result_raw)
-                success = True
-                break
-            except Exception as e:
-                log(f"Format issue on attempt {retry_count + 1}: {e}", log_file=args.log_file)
-                retry_count += 1
-            '''
-            try:
-                log(f"Prompt length (chars): {len(full_prompt)}", log_file=args.log_file)
-                #result_raw = run_ollama_inference(full_prompt, args.model_name, ollama_url)
-                result_raw = run_ollama_inference(full_prompt, args.model_name, ollama_url, timeout=120)
-                result = extract_json_from_ollama(result_raw)
-                success = True
-                break
-            except Exception as e:
-                log(f"Format issue on attempt {retry_count + 1}: {e}", log_file=args.log_file)
-
-                 # Show preview if available
-                preview = locals().get("result_raw", "")
-                if preview:
-                    preview_clean = preview[:300].replace("\n", " ").replace("\r", " ")
-                    log(f"[Invalid JSON Preview on attempt {retry_count + 1}] {preview_clean}", log_file=args.log_file)
-                retry_count += 1
-                # Raise if final attempt fails
-                if retry_count > args.max_retries:
-                    raise RuntimeError(f"Failed after {args.max_retries} attempts for chunk {fname}: {e}")
-
-        raw_out_path = os.path.join(args.output_dir, fname.replace(".txt", "_raw.txt"))
-        with open(raw_out_path, 'w', encoding='utf-8') as raw_file:
-            raw_file.write(result_raw)
-
-        out_path = os.path.join(args.output_dir, fname.replace(".txt", ".json"))
-        with open(out_path, 'w', encoding='utf-8') as out_file:
-            json.dump(result, out_file, indent=2)
-
-        log(f"Saved: {out_path}", log_file=args.log_file)
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Chunks are independent, so several can be in flight at once; Ollama
+    # batches them when the server runs with OLLAMA_NUM_PARALLEL > 1
+    num_parallel = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+    with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+        futures = submit_chunks(pool, args).values()
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing chunks"):
+                future.result()
+        except BaseException:
+            # Fail now instead of after every queued chunk has been sent to the model
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
 
 
 if __name__ == "__main__":
     main()
+    close_session()
 
@@ -3,22 +3,61 @@ import time
 import argparse
 import json
 import requests
+import urllib3
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    # ijson picks its fastest installed backend (yajl2_c when available)
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    # orjson is optional; fall back to the stdlib encoder/decoder
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    json_loads = json.loads
+
+import llm_cache
+from logutil import get_file_logger
 
 host = os.environ.get("OLLAMA_HOST", "127.0.0.1:11434")
 OLLAMA_URL = f"http://{host}/api/generate"
 
+# Pooled keep-alive connections to Ollama, shared by every inference call
+_SESSION = requests.Session()
+_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+_SESSION_HEADERS = {
+    "Connection": "keep-alive",
+    "Accept-Encoding": "gzip, deflate",
+    "Content-Type": "application/json",
+}
+
+
+def close_session():
+    _SESSION.close()
+
+
 def log(msg, log_file):
     time_stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     line = f"[{time_stamp}] {msg}"
     print(line)
-    with open(log_file, 'a', encoding='utf-8') as f:
-        f.write(line + "\n")
+    get_file_logger(log_file).info(line)
 
 def load_json(path):
-    with open(path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return json_loads(Path(path).read_bytes())
 
+# Templates are read once per process, even when pipeline stages run in-process
+@lru_cache(maxsize=16)
 def load_prompt_template(path):
     with open(path, 'r', encoding='utf-8') as f:
         return f.read()
@@ -34,24 +73,64 @@ def run_ollama_inference(prompt, model_name):
     return response.json()['response']
 '''
 
-def run_ollama_inference(prompt, model_name, timeout=120, log_file=None):
+def read_response_field(response):
+    """
+    Return the "response" field of an Ollama reply (None if absent).
+
+    With ijson the body is parsed as a stream, so the large "context" token
+    array that follows is never materialized as Python objects.
+    """
+    if not IJSON_AVAILABLE:
+        return json_loads(response.content).get('response')
+
+    response.raw.decode_content = True
+    try:
+        for prefix, event, value in ijson.parse(response.raw):
+            if prefix == 'response' and event == 'string':
+                return value
+        return None
+    except ijson.JSONError as e:
+        raise ValueError(str(e))
+    except urllib3.exceptions.HTTPError as e:
+        # Reading response.raw bypasses requests' own error mapping; map a
+        # stalled or broken body to the requests exceptions the caller handles
+        response.close()
+        if isinstance(e, urllib3.exceptions.ReadTimeoutError):
+            raise requests.exceptions.ReadTimeout(e)
+        raise requests.exceptions.ConnectionError(e)
+    finally:
+        # Discard the rest of the body so the connection can go back to the pool
+        response.raw.drain_conn()
+        response.raw.release_conn()
+
+
+def run_ollama_inference(prompt, model_name, timeout=120, log_file=None, use_cache=False):
+    if use_cache:
+        cached = llm_cache.get(model_name, prompt)
+        if cached is not None:
+            return cached
+
     log_msg = f"[run_ollama_inference] Sending prompt to model '{model_name}' (len={len(prompt)}) with timeout={timeout}s"
     print(log_msg)
     if log_file:
         log(log_msg, log_file)
     
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_URL,
-            json={
+            data=json_dumps({
                 "model": model_name,
                 "prompt": prompt,
                 "stream": False
-            },
+            }),
+            headers=_SESSION_HEADERS,
+            stream=True,
             timeout=timeout  # Timeout in seconds
         )
         response.raise_for_status()  # Raises HTTPError if not 200
-        return response.json()['response']
+        result = read_response_field(response)
+        if result is None:
+            raise KeyError('response')
 
     except requests.exceptions.Timeout:
         raise Exception("Ollama inference timed out.")
@@ -62,15 +141,111 @@ def run_ollama_inference(prompt, model_name, timeout=120, log_file=None):
     except requests.exceptions.RequestException as req_err:
         raise Exception(f"Request failed: {req_err}")
 
+    if use_cache:
+        llm_cache.put(model_name, prompt, result)
+    return result
+
 
-def inject_prompt(template, resolved_entities, aux_descriptions, chunk_text):
-    return template.strip() + "\n\n" + json.dumps({
+def build_static_prefix(template, resolved_entities, aux_descriptions):
+    # Everything up to the TEXT_CHUNK value. The memory is identical for every
+    # chunk and retry, so it is serialized once and the prompt prefix stays
+    # byte-stable for Ollama's prompt cache
+    payload = json.dumps({
         "RESOLVED_ENTITIES": resolved_entities,
         "AUXILIARY_DESCRIPTIONS": aux_descriptions,
-        "TEXT_CHUNK": chunk_text
+        "TEXT_CHUNK": None
     }, indent=2)
+    return template.strip() + "\n\n" + payload[:payload.rindex("null")]
+
+def inject_prompt(static_prefix, chunk_text):
+    # Same text as json.dumps of the full payload with indent=2
+    return "".join((static_prefix, json.dumps(chunk_text), "\n}"))
+
+def schedule_chunks(chunks_dir, chunk_files, schedule):
+    """
+    Order chunk files for submission. "fifo" keeps file order; "lpt" sends the
+    largest chunks first, so the slowest requests do not start last and leave
+    the other workers idle at the end of the run.
+    """
+    if schedule == "lpt":
+        return sorted(chunk_files, key=lambda f: os.path.getsize(os.path.join(chunks_dir, f)), reverse=True)
+    return chunk_files
+
+def resolve_chunk(fname, args, static_prefix, resolved_dir, log_file):
+    chunk_name = fname.replace(".txt", "")
+    chunk_path = os.path.join(args.chunks_dir, fname)
+    chunk_text = Path(chunk_path).read_bytes().decode('utf-8')
+
+    '''
+    prompt = inject_prompt(prompt_template, resolved_entities, aux_descriptions, chunk_text)
+
+    log(f"Resolving coreference for {chunk_name}...", log_file)
+    try:
+        resolved_text = run_ollama_inference(prompt, args.model_name)
+        out_path = os.path.join(resolved_dir, chunk_name + "_resolved.txt")
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write(resolved_text)
+        log(f"Saved resolved text: {out_path}", log_file)
+    except Exception as e:
+        log(f"Failed to process {chunk_name}: {e}", log_file)
+        raise
+    '''
+
+    input_text = chunk_text
+    '''
+    for retry in range(args.num_retries):
+        prompt = inject_prompt(static_prefix, input_text)
+        log(f"[Retry {retry+1}/{args.num_retries}] Resolving coreference for {chunk_name}...", log_file)
+        try:
+            log(f"Prompt length (chars): {len(prompt)}", log_file)
+            input_text = run_ollama_inference(prompt, args.model_name, timeout=120)
+        except Exception as e:
+            log(f"Failed at retry {retry+1} for {chunk_name}: {e}", log_file)
+            raise
+    '''
+
+    # input_text only changes on success, which ends the loop, so every retry
+    # sends the same prompt
+    prompt = inject_prompt(static_prefix, input_text)
+    for retry in range(args.num_retries):
+        log(f"[Retry {retry+1}/{args.num_retries}] Resolving coreference for {chunk_name}...", log_file)
+        log(f"Prompt length (chars): {len(prompt)}", log_file)
 
-def main():
+        start_time = time.time()
+
+        try:
+            input_text = run_ollama_inference(prompt, args.model_name, timeout=120, log_file=args.log_file, use_cache=args.use_cache)
+            elapsed = round(time.time() - start_time, 2)
+            log(f"Response received in {elapsed} seconds for {chunk_name}", log_file)
+            break
+
+        except Exception as e:
+            log(f"Retry {retry+1} failed for {chunk_name}: {e}", log_file)
+
+            if "timed out" in str(e).lower():
+                log(f"Retrying {chunk_name} with extended timeout (300s)...", log_file)
+                try:
+                    retry_start = time.time()
+                    input_text = run_ollama_inference(prompt, args.model_name, timeout=300, use_cache=args.use_cache)
+                    retry_elapsed = round(time.time() - retry_start, 2)
+                    log(f"Extended timeout succeeded in {retry_elapsed} seconds for {chunk_name}", log_file)
+                    break
+                except Exception as e2:
+                    log(f"Extended timeout also failed at retry {retry+1} for {chunk_name}: {e2}", log_file)
+
+            if retry == args.num_retries - 1:
+                log(f"Final Resolution failed for {chunk_name}.", log_file)
+                with open(f"debug_failed_prompt_{chunk_name}.txt", "w", encoding="utf-8") as f:
+                    f.write(prompt)
+                raise
+
+    resolved_text = input_text
+    out_path = os.path.join(resolved_dir, chunk_name + "_resolved.txt")
+    with open(out_path, 'w', encoding='utf-8') as f:
+        f.write(resolved_text)
+    log(f"Saved resolved text: {out_path}", log_file)
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--chunks-dir", required=True)
     parser.add_argument("--final-memory", required=True)
@@ -81,8 +256,11 @@ def main():
     parser.add_argument("--log-file", default=None, help="Path to the log file")
     parser.add_argument("--num-retries", type=int, default=1, help="Number of times to reprocess each chunk to improve resolution")
     parser.add_argument("--entity-type", required=True)
+    parser.add_argument("--use-cache", action="store_true", help="Reuse cached Ollama responses for identical prompts")
+    parser.add_argument("--schedule", choices=["fifo", "lpt"], default="fifo",
+                        help="Submission order: file order, or largest chunks first (lpt)")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     #input_folder = os.path.join(args.base_output_dir, args.input_file_name)
     input_folder = args.base_output_dir 
@@ -108,89 +286,33 @@ def main():
     memory["RESOLVED_ENTITIES"] = resolved_entities
     log(f"{len(resolved_entities)} valid RESOLVED_ENTITIES retained for final resolution.", args.log_file)
     prompt_template = load_prompt_template(args.prompt_file)
-
-    chunk_files = sorted([f for f in os.listdir(args.chunks_dir) if f.endswith(".txt")])
-    for fname in chunk_files:
-        chunk_name = fname.replace(".txt", "")
-        chunk_path = os.path.join(args.chunks_dir, fname)
-        with open(chunk_path, 'r', encoding='utf-8') as f:
-            chunk_text = f.read()
-
-        '''
-        prompt = inject_prompt(prompt_template, resolved_entities, aux_descriptions, chunk_text)
-
-        log(f"Resolving coreference for {chunk_name}...", log_file)
+    static_prefix = build_static_prefix(prompt_template, resolved_entities, aux_descriptions)
+
+    chunk_files = sorted(e.name for e in os.scandir(args.chunks_dir) if e.name.endswith(".txt") and e.is_file())
+    # Every chunk is resolved against the same memory, so chunks can be sent
+    # to Ollama concurrently (served in parallel with OLLAMA_NUM_PARALLEL > 1)
+    num_parallel = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+    with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+        futures = [
+            pool.submit(resolve_chunk, fname, args, static_prefix, resolved_dir, log_file)
+            for fname in schedule_chunks(args.chunks_dir, chunk_files, args.schedule)
+        ]
         try:
-            resolved_text = run_ollama_inference(prompt, args.model_name)
-            out_path = os.path.join(resolved_dir, chunk_name + "_resolved.txt")
-            with open(out_path, 'w', encoding='utf-8') as f:
-                f.write(resolved_text)
-            log(f"Saved resolved text: {out_path}", log_file)
-        except Exception as e:
-            log(f"Failed to process {chunk_name}: {e}", log_file)
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # Fail now instead of after every queued chunk has been sent to the model
+            pool.shutdown(wait=False, cancel_futures=True)
             raise
-        '''
-
-        input_text = chunk_text
-        '''
-        for retry in range(args.num_retries):
-            prompt = inject_prompt(prompt_template, resolved_entities, aux_descriptions, input_text)
-            log(f"[Retry {retry+1}/{args.num_retries}] Resolving coreference for {chunk_name}...", log_file)
-            try:
-                log(f"Prompt length (chars): {len(prompt)}", log_file)
-                input_text = run_ollama_inference(prompt, args.model_name, timeout=120)
-            except Exception as e:
-                log(f"Failed at retry {retry+1} for {chunk_name}: {e}", log_file)
-                raise
-        '''
-
-        for retry in range(args.num_retries):
-            prompt = inject_prompt(prompt_template, resolved_entities, aux_descriptions, input_text)
-            log(f"[Retry {retry+1}/{args.num_retries}] Resolving coreference for {chunk_name}...", log_file)
-            log(f"Prompt length (chars): {len(prompt)}", log_file)
-
-            start_time = time.time()
-
-            try:
-                input_text = run_ollama_inference(prompt, args.model_name, timeout=120, log_file=args.log_file)
-                elapsed = round(time.time() - start_time, 2)
-                log(f"Response received in {elapsed} seconds for {chunk_name}", log_file)
-                break
-
-            except Exception as e:
-                log(f"Retry {retry+1} failed for {chunk_name}: {e}", log_file)
-
-                if "timed out" in str(e).lower():
-                    log(f"Retrying {chunk_name} with extended timeout (300s)...", log_file)
-                    try:
-                        retry_start = time.time()
-                        input_text = run_ollama_inference(prompt, args.model_name, timeout=300)
-                        retry_elapsed = round(time.time() - retry_start, 2)
-                        log(f"Extended timeout succeeded in {retry_elapsed} seconds for {chunk_name}", log_file)
-                        break
-                    except Exception as e2:
-                        log(f"Extended timeout also failed at retry {retry+1} for {chunk_name}: {e2}", log_file)
-
-                if retry == args.num_retries - 1:
-                    log(f"Final Resolution failed for {chunk_name}.", log_file)
-                    with open(f"debug_failed_prompt_{chunk_name}.txt", "w", encoding="utf-8") as f:
-                        f.write(prompt)
-                    raise
-
-        resolved_text = input_text
-        out_path = os.path.join(resolved_dir, chunk_name + "_resolved.txt")
-        with open(out_path, 'w', encoding='utf-8') as f:
-            f.write(resolved_text)
-        log(f"Saved resolved text: {out_path}", log_file)
 
     # === Merge all resolved chunks into one final file ===
     merged_path = os.path.join(input_folder, f"{args.entity_type}_resolved_{args.input_file_name}.txt")
     log(f"Merging all resolved chunks into {merged_path}", log_file)
 
-    resolved_files = sorted([
-        f for f in os.listdir(resolved_dir)
-        if f.endswith("_resolved.txt")
-    ])
+    resolved_files = sorted(
+        e.name for e in os.scandir(resolved_dir)
+        if e.name.endswith("_resolved.txt") and e.is_file()
+    )
 
     with open(merged_path, 'w', encoding='utf-8') as merged_file:
         for fname in resolved_files:
@@ -204,3 +326,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    close_session()
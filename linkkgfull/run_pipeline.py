@@ -1,17 +1,47 @@
 import argparse
+import importlib
 import subprocess
+import traceback
 import os
 import time
 from datetime import datetime
 
+from logutil import get_file_logger
+
 # STEP 1: Logging utility
 def log(message, log_file=None):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     full_msg = f"[{timestamp}] {message}"
     print(full_msg)
     if log_file:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(full_msg + '\n')
+        get_file_logger(log_file).info(full_msg)
+
+def run_stage(args, cmd):
+    """
+    Run a stage given as ["python", "<script>.py", *argv] and return its exit code.
+    By default the script's main(argv) is called in-process, which skips the
+    interpreter start-up and re-imports for every stage and lets the stages
+    share their HTTP connection pools; --subprocess restores one process per stage.
+    """
+    if args.subprocess:
+        return subprocess.run(cmd).returncode
+
+    module = importlib.import_module(os.path.splitext(cmd[1])[0])
+    return call_in_process(module.main, cmd[2:])
+
+def call_in_process(func, *func_args, **func_kwargs):
+    """Call a stage entry point and map SystemExit / exceptions to an exit code."""
+    try:
+        func(*func_args, **func_kwargs)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
 
 # STEP 2: Chunking Stage
 def run_chunk_stage(args, input_file_name, output_dir, log_file):
@@ -31,10 +61,10 @@ def run_chunk_stage(args, input_file_name, output_dir, log_file):
     if args.use_tokenizer:
         chunk_cmd.append("--use-tokenizer")
 
-    result = subprocess.run(chunk_cmd)
+    returncode = run_stage(args, chunk_cmd)
     end = time.time()
 
-    if result.returncode == 0:
+    if returncode == 0:
         log(f"Chunking completed in {end - start:.2f} seconds.", log_file)
     else:
         log("Chunking failed.", log_file)
@@ -42,15 +72,8 @@ def run_chunk_stage(args, input_file_name, output_dir, log_file):
 
     return chunk_output_dir
 
-# STEP 3: NER Stage
-def run_ner_stage(args, chunk_output_dir, output_dir, log_file):
-    log("Starting NER Step...", log_file)
-    start = time.time()
-
-    ner_output_dir = os.path.join(output_dir, "ner_outputs")
-    os.makedirs(ner_output_dir, exist_ok=True)
-
-    ner_cmd = [
+def ner_command(args, chunk_output_dir, ner_output_dir, log_file):
+    return [
         "python", "ner.py",
         "--chunks-dir", chunk_output_dir,
         "--prompt-file", args.ner_prompt_file,
@@ -60,22 +83,7 @@ def run_ner_stage(args, chunk_output_dir, output_dir, log_file):
         "--max-retries", str(args.ner_max_retries)
     ]
 
-    result = subprocess.run(ner_cmd)
-    end = time.time()
-
-    if result.returncode == 0:
-        log(f"NER completed in {end - start:.2f} seconds.", log_file)
-    else:
-        log("NER failed.", log_file)
-        exit(1)
-
-    return ner_output_dir
-
-# STEP 4: Coreference Resolution
-def run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file):
-    log("Starting Coreference Resolution Step...", log_file)
-    start = time.time()
-
+def coref_command(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file):
     coref_cmd = [
         "python", "loopcoref.py",
         "--chunks-dir", chunk_output_dir,
@@ -91,16 +99,104 @@ def run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_fi
 
     if args.coref_verify_prompt_file:
         coref_cmd.extend(["--verify-prompt-file", args.coref_verify_prompt_file])
+    return coref_cmd
+
+# STEP 3: NER Stage
+def run_ner_stage(args, chunk_output_dir, output_dir, log_file):
+    log("Starting NER Step...", log_file)
+    start = time.time()
+
+    ner_output_dir = os.path.join(output_dir, "ner_outputs")
+    os.makedirs(ner_output_dir, exist_ok=True)
+
+    ner_cmd = ner_command(args, chunk_output_dir, ner_output_dir, log_file)
+
+    returncode = run_stage(args, ner_cmd)
+    end = time.time()
 
-    result = subprocess.run(coref_cmd)
+    if returncode == 0:
+        log(f"NER completed in {end - start:.2f} seconds.", log_file)
+    else:
+        log("NER failed.", log_file)
+        exit(1)
+
+    return ner_output_dir
+
+# STEP 4: Coreference Resolution
+def run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file):
+    log("Starting Coreference Resolution Step...", log_file)
+    start = time.time()
+
+    coref_cmd = coref_command(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file)
+
+    returncode = run_stage(args, coref_cmd)
     end = time.time()
 
-    if result.returncode == 0:
+    if returncode == 0:
         log(f"Coreference Resolution completed in {end - start:.2f} seconds.", log_file)
     else:
         log("Coreference Resolution failed.", log_file)
         exit(1)
 
+# STEP 3b: NER and Coreference Resolution overlapped
+def run_ner_coref_pipelined(args, chunk_output_dir, output_dir, input_file_name, log_file):
+    """
+    Start NER in the background and coref right away. Coref still walks the
+    chunks in order (each one extends the shared memory) but only waits for
+    the NER output of the chunk it is on, so both stages run at the same time.
+    Needs an Ollama server that can keep both models loaded
+    (OLLAMA_MAX_LOADED_MODELS >= 2, unless the same model is used for both).
+    """
+    log("Starting NER + Coreference Resolution (overlapped)...", log_file)
+    start = time.time()
+
+    ner_output_dir = os.path.join(output_dir, "ner_outputs")
+    os.makedirs(ner_output_dir, exist_ok=True)
+
+    ner_cmd = ner_command(args, chunk_output_dir, ner_output_dir, log_file)
+    coref_cmd = coref_command(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file)
+    coref_cmd.extend(["--wait-for-ner", str(args.ner_wait_timeout)])
+
+    # Coref takes any existing NER output as final, so drop what an earlier run left
+    for fname in os.listdir(chunk_output_dir):
+        if fname.endswith(".txt"):
+            stale_path = os.path.join(ner_output_dir, fname.replace(".txt", ".json"))
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    ner_proc = subprocess.Popen(ner_cmd)
+    coref_proc = subprocess.Popen(coref_cmd)
+
+    # Coref would otherwise keep waiting for NER output that will never come
+    while coref_proc.poll() is None:
+        if ner_proc.poll() not in (None, 0):
+            coref_proc.terminate()
+            coref_proc.wait()
+            break
+        time.sleep(1)
+
+    # Without coref the remaining NER chunks are wasted Ollama time
+    coref_failed_first = coref_proc.returncode != 0 and ner_proc.poll() is None
+    if coref_failed_first:
+        ner_proc.terminate()
+        try:
+            ner_proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            ner_proc.kill()
+
+    ner_returncode = ner_proc.wait()
+    end = time.time()
+
+    if ner_returncode != 0 and not coref_failed_first:
+        log("NER failed.", log_file)
+        exit(1)
+    if coref_proc.returncode != 0:
+        log("Coreference Resolution failed.", log_file)
+        exit(1)
+    log(f"NER + Coreference Resolution completed in {end - start:.2f} seconds.", log_file)
+
+    return ner_output_dir
+
 # STEP 5: Final Resolution
 def run_resolve_stage(args, chunk_output_dir, output_dir, input_file_name, log_file):
     log("Starting Final Coref Resolution Step...", log_file)
@@ -124,10 +220,10 @@ def run_resolve_stage(args, chunk_output_dir, output_dir, input_file_name, log_f
         "--entity-type", str(args.entity_type)
     ]
 
-    result = subprocess.run(resolve_cmd)
+    returncode = run_stage(args, resolve_cmd)
     end = time.time()
 
-    if result.returncode == 0:
+    if returncode == 0:
         log(f"Final Resolution completed in {end - start:.2f} seconds.", log_file)
     else:
         log("Final Resolution failed.", log_file)
@@ -136,7 +232,21 @@ def run_resolve_stage(args, chunk_output_dir, output_dir, input_file_name, log_f
 # STEP 6: Main Pipeline Controller
 def main():
     cumulative_time = 0.0
-    parser = argparse.ArgumentParser(description="Run full pipeline on legal text.")
+    parser = argparse.ArgumentParser(
+        description="Run full pipeline on legal text.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=(
+            "environment:\n"
+            "  OLLAMA_HOST  host:port that every stage sends /api/generate requests to\n"
+            "               (default 127.0.0.1:11434). To put a gateway or caching proxy\n"
+            "               with the same /api/generate API in front of Ollama (for\n"
+            "               caching, batching, rate limiting or health checks shared\n"
+            "               across runs), start it and point OLLAMA_HOST at its port:\n"
+            "                 OLLAMA_HOST=127.0.0.1:8080 python run_pipeline.py ...\n"
+            "               The stages keep their own retries; the per-stage --use-cache\n"
+            "               disk cache is then redundant with a caching proxy."
+        )
+    )
     parser.add_argument("--input-file-name", required=True, help="Name to use for output folder (do not include extension).")
     parser.add_argument("--entity-type", required=True, help="Entity type to process (e.g., person, location, org, etc.)")
 
@@ -164,6 +274,14 @@ def main():
 
     # Stage control
     parser.add_argument("--run-stages", nargs="+", choices=["chunk", "ner", "coref", "resolve"], required=True)
+    parser.add_argument("--pipeline-ner-coref", action="store_true",
+                        help="When running both ner and coref, overlap them: coref starts on each chunk "
+                             "as soon as its NER output is written")
+    parser.add_argument("--ner-wait-timeout", type=int, default=1800,
+                        help="With --pipeline-ner-coref, seconds coref waits for one chunk's NER output")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="Run each stage in its own Python process instead of in-process "
+                             "(--pipeline-ner-coref always uses two processes)")
 
     args = parser.parse_args()
 
@@ -186,8 +304,17 @@ def main():
         if not os.path.exists(chunk_output_dir):
             raise FileNotFoundError(f"Chunk output not found at {chunk_output_dir}. Run with 'chunk' stage.")
 
-    # NER Stage
-    if "ner" in args.run_stages:
+    pipelined = args.pipeline_ner_coref and "ner" in args.run_stages and "coref" in args.run_stages
+
+    # NER Stage (and Coref, when overlapped)
+    if pipelined:
+        stage_start = time.time()
+        ner_output_dir = run_ner_coref_pipelined(args, chunk_output_dir, output_dir, input_file_name, log_file)
+        stage_end = time.time()
+        stage_duration = stage_end - stage_start
+        cumulative_time += stage_duration
+        log(f"Cumulative time after NER + Coref: {cumulative_time:.2f} seconds.", log_file)
+    elif "ner" in args.run_stages:
         stage_start = time.time()
         ner_output_dir = run_ner_stage(args, chunk_output_dir, output_dir, log_file)
         stage_end = time.time()
@@ -200,7 +327,9 @@ def main():
             raise FileNotFoundError(f"NER output not found at {ner_output_dir}. Run with 'ner' stage.")
 
     # Coref Stage
-    if "coref" in args.run_stages:
+    if pipelined:
+        pass  # Already ran alongside NER
+    elif "coref" in args.run_stages:
         stage_start = time.time()
         run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file)
         stage_end = time.time()
@@ -1,16 +1,73 @@
 import argparse
+import importlib
 import subprocess
+import traceback
 import os
 import time
+import requests
 from datetime import datetime
 
+from logutil import get_file_logger
+
+
 def log(message, log_file=None):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     full_msg = f"[{timestamp}] {message}"
     print(full_msg)
     if log_file:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(full_msg + '\n')
+        get_file_logger(log_file).info(full_msg)
+
+def stage_env(args):
+    # ner.py / resolve_coref.py size their request pools from OLLAMA_NUM_PARALLEL.
+    # The Ollama server only honors these when it is started with the same values.
+    env = os.environ.copy()
+    env["OLLAMA_NUM_PARALLEL"] = str(args.ollama_num_parallel)
+    env["OLLAMA_MAX_LOADED_MODELS"] = str(args.ollama_max_loaded_models)
+    return env
+
+def check_loaded_models(args, log_file):
+    host = os.environ.get("OLLAMA_HOST", "127.0.0.1:11434")
+    models = {args.ner_model_name, args.coref_model_name, args.resolve_model_name}
+    try:
+        response = requests.get(f"http://{host}/api/ps", timeout=5)
+        response.raise_for_status()
+        loaded = {m.get("name") for m in response.json().get("models", [])}
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log(f"Could not query Ollama for loaded models: {e}", log_file)
+        return
+
+    for model in sorted(models):
+        if model in loaded or f"{model}:latest" in loaded:
+            log(f"Model already loaded in Ollama: {model}", log_file)
+        else:
+            log(f"Model not loaded yet, first request will pay the load time: {model}", log_file)
+
+def run_stage(args, cmd):
+    """
+    Run a stage given as ["python", "<script>.py", *argv] and return its exit code.
+    By default the script's main(argv) is called in-process, which skips the
+    interpreter start-up and re-imports and keeps the Ollama connection pool
+    alive across stages; --subprocess restores one process per stage.
+    """
+    if args.subprocess:
+        return subprocess.run(cmd, env=stage_env(args)).returncode
+
+    module = importlib.import_module(os.path.splitext(cmd[1])[0])
+    return call_in_process(module.main, cmd[2:])
+
+def call_in_process(func, *func_args, **func_kwargs):
+    """Call a stage entry point and map SystemExit / exceptions to an exit code."""
+    try:
+        func(*func_args, **func_kwargs)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
 
 def run_chunk_stage(args, input_file_name, output_dir, log_file):
     log("Starting chunking step...", log_file)
@@ -29,23 +86,17 @@ def run_chunk_stage(args, input_file_name, output_dir, log_file):
     if args.use_tokenizer:
         chunk_cmd.append("--use-tokenizer")
 
-    result = subprocess.run(chunk_cmd)
+    returncode = run_stage(args, chunk_cmd)
     end = time.time()
 
-    if result.returncode == 0:
+    if returncode == 0:
         log(f"Chunking completed successfully in {end - start:.2f} seconds.", log_file)
     else:
         log("Chunking failed. Error details:", log_file)
         exit(1)
 
-def run_ner_stage(args, chunk_output_dir, output_dir, log_file):
-    log("Starting NER step...", log_file)
-    start = time.time()
-
-    ner_output_dir = os.path.join(output_dir, "ner_outputs")
-    os.makedirs(ner_output_dir, exist_ok=True)
-
-    ner_cmd = [
+def ner_command(args, chunk_output_dir, ner_output_dir, log_file):
+    return [
         "python", "ner.py",
         "--chunks-dir", chunk_output_dir,
         "--prompt-file", args.ner_prompt_file,
@@ -55,19 +106,7 @@ def run_ner_stage(args, chunk_output_dir, output_dir, log_file):
         "--max-retries", str(args.ner_max_retries)
     ]
 
-    result = subprocess.run(ner_cmd)
-    end = time.time()
-
-    if result.returncode == 0:
-        log(f"NER completed successfully in {end - start:.2f} seconds.", log_file)
-    else:
-        log("NER failed. Error details:", log_file)
-        exit(1)
-
-def run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file):
-    log("Starting Coreference Resolution step...", log_file)
-    start = time.time()
-
+def coref_command(args, chunk_output_dir, ner_output_dir, input_file_name, log_file):
     coref_cmd = [
         "python", "loopcoref.py",
         "--chunks-dir", chunk_output_dir,
@@ -82,16 +121,79 @@ def run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_fi
 
     if args.coref_verify_prompt_file:
         coref_cmd.extend(["--verify-prompt-file", args.coref_verify_prompt_file])
+    return coref_cmd
+
+def run_ner_stage(args, chunk_output_dir, output_dir, log_file):
+    log("Starting NER step...", log_file)
+    start = time.time()
 
-    result = subprocess.run(coref_cmd)
+    ner_output_dir = os.path.join(output_dir, "ner_outputs")
+    os.makedirs(ner_output_dir, exist_ok=True)
+
+    ner_cmd = ner_command(args, chunk_output_dir, ner_output_dir, log_file)
+    returncode = run_stage(args, ner_cmd)
     end = time.time()
 
-    if result.returncode == 0:
+    if returncode == 0:
+        log(f"NER completed successfully in {end - start:.2f} seconds.", log_file)
+    else:
+        log("NER failed. Error details:", log_file)
+        exit(1)
+
+def run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file):
+    log("Starting Coreference Resolution step...", log_file)
+    start = time.time()
+
+    coref_cmd = coref_command(args, chunk_output_dir, ner_output_dir, input_file_name, log_file)
+    returncode = run_stage(args, coref_cmd)
+    end = time.time()
+
+    if returncode == 0:
         log(f"Coreference Resolution completed successfully in {end - start:.2f} seconds.", log_file)
     else:
         log("Coreference Resolution failed. Error details:", log_file)
         exit(1)
 
+def run_ner_coref_pipelined(args, chunk_output_dir, output_dir, input_file_name, log_file):
+    """
+    NER and coref as a chunk-level pipeline instead of two barrier stages: NER
+    runs on all chunks in the background and coref starts on chunk k as soon as
+    NER(k) is written. Coref itself stays in chunk order because every chunk
+    extends the shared memory, and the resolve stage still waits for
+    final_memory.json.
+    """
+    import ner
+    import loopcoref
+    from concurrent.futures import ThreadPoolExecutor
+
+    log("Starting NER + Coreference Resolution (pipelined per chunk)...", log_file)
+    start = time.time()
+
+    ner_output_dir = os.path.join(output_dir, "ner_outputs")
+    os.makedirs(ner_output_dir, exist_ok=True)
+
+    ner_args = ner.parse_args(ner_command(args, chunk_output_dir, ner_output_dir, log_file)[2:])
+    coref_argv = coref_command(args, chunk_output_dir, ner_output_dir, input_file_name, log_file)[2:]
+
+    def run():
+        with ThreadPoolExecutor(max_workers=args.ollama_num_parallel) as pool:
+            ner_futures = ner.submit_chunks(pool, ner_args)
+            try:
+                loopcoref.main(coref_argv, ner_futures=ner_futures)
+            except BaseException:
+                # Otherwise leaving the with block waits for every queued NER chunk
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    returncode = call_in_process(run)
+    end = time.time()
+
+    if returncode == 0:
+        log(f"NER + Coreference Resolution completed successfully in {end - start:.2f} seconds.", log_file)
+    else:
+        log("NER + Coreference Resolution failed. Error details:", log_file)
+        exit(1)
+
 def run_resolve_stage(args, chunk_output_dir, output_dir, input_file_name, log_file):
     log("Starting Final Coref Resolution step...", log_file)
     start = time.time()
@@ -111,10 +213,10 @@ def run_resolve_stage(args, chunk_output_dir, output_dir, input_file_name, log_f
         "--model-name", args.resolve_model_name
     ]
 
-    result = subprocess.run(resolve_cmd)
+    returncode = run_stage(args, resolve_cmd)
     end = time.time()
 
-    if result.returncode == 0:
+    if returncode == 0:
         log(f"Final Coref Resolution completed successfully in {end - start:.2f} seconds.", log_file)
     else:
         log("Final Coref Resolution failed. Error details:", log_file)
@@ -141,7 +243,16 @@ def main():
     # Final Resolution args
     parser.add_argument("--resolve-prompt-file", required=True)
     parser.add_argument("--resolve-model-name", required=True)
-    
+
+    # Ollama concurrency args
+    parser.add_argument("--ollama-num-parallel", type=int, default=4,
+                        help="OLLAMA_NUM_PARALLEL for the stages (concurrent requests per model)")
+    parser.add_argument("--ollama-max-loaded-models", type=int, default=1,
+                        help="OLLAMA_MAX_LOADED_MODELS for the stages")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="Run each stage in its own Python process instead of in-process "
+                             "(NER and coref then run as separate barrier stages)")
+
     args = parser.parse_args()
 
     input_file_name = os.path.splitext(os.path.basename(args.input_file))[0]
@@ -150,14 +261,24 @@ def main():
 
     log_file = os.path.join(output_dir, "log.txt")
     log(f"Pipeline started for {input_file_name}", log_file)
+    log(f"OLLAMA_NUM_PARALLEL={args.ollama_num_parallel}, "
+        f"OLLAMA_MAX_LOADED_MODELS={args.ollama_max_loaded_models}", log_file)
+    check_loaded_models(args, log_file)
+
+    if not args.subprocess:
+        # In-process stages read these from this process's environment
+        os.environ.update(stage_env(args))
 
     run_chunk_stage(args, input_file_name, output_dir, log_file)
 
     chunk_output_dir = os.path.join(output_dir, "chunk_outputs")
-    run_ner_stage(args, chunk_output_dir, output_dir, log_file)
+    if args.subprocess:
+        run_ner_stage(args, chunk_output_dir, output_dir, log_file)
 
-    ner_output_dir = os.path.join(output_dir, "ner_outputs")
-    run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file)
+        ner_output_dir = os.path.join(output_dir, "ner_outputs")
+        run_coref_stage(args, chunk_output_dir, ner_output_dir, output_dir, input_file_name, log_file)
+    else:
+        run_ner_coref_pipelined(args, chunk_output_dir, output_dir, input_file_name, log_file)
 
     run_resolve_stage(args, chunk_output_dir, output_dir, input_file_name, log_file)
 